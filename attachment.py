@@ -6,140 +6,196 @@
 # The hands are named using our "bvh.py" and "leap_reader.py" script
 # ==========================================================================
 
+import os
+import sys
 import bpy
-from numpy import array, zeros, argmin, inf
-from numpy.linalg import norm
 from mathutils import *
+from numpy import array, arange, empty, zeros, full, float32, int32, \
+    minimum, searchsorted, nonzero, floor, concatenate, argsort
 
-# ==========================================================================
-#   DTW implementation courtesy of Pierre Rouanet:
-#   http://github.com/pierre-rouanet/dtw
-#   See examples that he posts
-# ==========================================================================
+# Blender does not put the script's folder on the path, the DTW code lives
+# next to this file in dtw.py
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+from dtw import warp_path, stack_curves
+from retarget import Skeleton, attachSkeleton
+from bone_index import BoneIndex
 
-def dtw(x, y, dist=lambda x, y: norm(x - y, ord=1)):
-    """ Computes the DTW of two sequences.
 
-    :param array x: N1*M array
-    :param array y: N2*M array
-    :param func dist: distance used as cost measure (default L1 norm)
+# ==========================================================================
+#   Get the rotation given mocap to search in, bonename, and frame
+#   "action" is a blender Action, "bonename" is a string, "frame" is an int
+#   blender Actions can be found in bpy.data.actions
+# ==========================================================================
+def get_rotation(action, bonename, frame=1):
+    rot = Euler([0, 0, 0])
+    data_path = 'pose.bones["%s"].rotation_euler' % (bonename)
+    for fc in action.fcurves:
+        if fc.data_path == data_path:
+            rot[fc.array_index] = fc.evaluate(frame)
+    return(rot)
 
-    Returns the minimum distance, the accumulated cost matrix and the wrap path.
+# ==========================================================================
+#   Samples the rotation FCurves of an Action into NumPy arrays
+#   The FCurves are indexed by (data_path, array_index) once, so reading a
+#   bone doesn't scan every FCurve of the action for every frame
+#   Frames that land on a keyframe (every frame of an imported BVH) are read
+#   in bulk from the keyframe buffer, the others are evaluated
+#   "action" is a blender Action
+# ==========================================================================
 
-    """
-    x = array(x)
-    if len(x.shape) == 1:
-        x = x.reshape(-1, 1)
-    y = array(y)
-    if len(y.shape) == 1:
-        y = y.reshape(-1, 1)
 
-    r, c = len(x), len(y)
+class RotationSampler:
 
-    D = zeros((r + 1, c + 1))
-    D[0, 1:] = inf
-    D[1:, 0] = inf
+    def __init__(self, action):
+        self.curves = {}
+        for fc in action.fcurves:
+            self.curves[(fc.data_path, fc.array_index)] = fc
 
-    for i in range(r):
-        for j in range(c):
-            D[i+1, j+1] = dist(x[i], y[j])
+        # Same frame range as listRotation: 1 to the end of the first curve
+        self.frames = arange(1, int(action.fcurves[0].range()[1]) + 1)
 
-    for i in range(r):
-        for j in range(c):
-            D[i+1, j+1] += min(D[i, j], D[i, j+1], D[i+1, j])
+    # values of one FCurve at every frame
+    def sampleCurve(self, fc):
+        frames = self.frames
+        values = empty(len(frames))
+        hit = zeros(len(frames), dtype=bool)
 
-    D = D[1:, 1:]
+        # modifiers change the evaluated value, the keys can't be used as is
+        keys = fc.keyframe_points
+        if len(keys) > 0 and len(fc.modifiers) == 0:
+            co = empty(2 * len(keys), dtype=float32)
+            keys.foreach_get("co", co)
+            times, keyValues = co[0::2], co[1::2]
 
-    dist = D[-1, -1] / sum(D.shape)
+            k = minimum(searchsorted(times, frames), len(times) - 1)
+            hit = times[k] == frames
+            values[hit] = keyValues[k[hit]]
 
-    return dist, D, _trackeback(D)
+        for i in nonzero(~hit)[0]:
+            values[i] = fc.evaluate(frames[i])
+        return values
 
+    # frames*3 array of a bone's rotation, rot[i] is the i+1th frame
+    # missing channels are left at 0 like get_rotation
+    def sample(self, bonename):
+        if bonename[-3:] == "001":
+            bonename = bonename[:-4]
+        data_path = 'pose.bones["%s"].rotation_euler' % (bonename)
 
-def _trackeback(D):
-    i, j = array(D.shape) - 1
-    p, q = [i], [j]
-    while (i > 0 and j > 0):
-        tb = argmin((D[i-1, j-1], D[i-1, j], D[i, j-1]))
+        rot = zeros((len(self.frames), 3))
+        for axis in range(3):
+            fc = self.curves.get((data_path, axis))
+            if fc is not None:
+                rot[:, axis] = self.sampleCurve(fc)
+        return rot
 
-        if (tb == 0):
-            i = i - 1
-            j = j - 1
-        elif (tb == 1):
-            i = i - 1
-        elif (tb == 2):
-            j = j - 1
+# ==========================================================================
+#   Creates a list containing the rotations of a bone
+#   rot[i] equals the i+1th frame of animation
+#   "action" is a blender Action, "bonename" is a string
+#   Use RotationSampler directly when reading several bones
+# ==========================================================================
 
-        p.insert(0, i)
-        q.insert(0, j)
 
-    p.insert(0, 0)
-    q.insert(0, 0)
-    return (array(p), array(q))
+def listRotation(action, bonename):
+    return [Euler(r) for r in RotationSampler(action).sample(bonename)]
 
-# ==========================================================================
+# Per keyframe properties copied by writeKeyframes: (x, y) pairs and enums
+# with the value new keys get (like keyframe_points.insert)
+KEY_VECTORS = ("co", "handle_left", "handle_right")
+KEY_ENUMS = (("interpolation", "BEZIER"),
+             ("handle_left_type", "AUTO_CLAMPED"),
+             ("handle_right_type", "AUTO_CLAMPED"),
+             ("easing", "AUTO"),
+             ("type", "KEYFRAME"))
 
 
-# ==========================================================================
-#   Get the rotation given mocap to search in, bonename, and frame
-#   "action" is a blender Action, "bonename" is a string, "frame" is an int
-#   blender Actions can be found in bpy.data.actions
-# ==========================================================================
-def get_rotation(action, bonename, frame=1):
-    rot = Euler([0, 0, 0])
-    data_path = 'pose.bones["%s"].rotation_euler' % (bonename)
-    for fc in action.fcurves:
-        if fc.data_path == data_path:
-            rot[fc.array_index] = fc.evaluate(frame)
-    return(rot)
+def keyEnums():
+    # foreach_get/set read enums as their C value, looked up through RNA
+    # (easing and type only exist in newer versions of Blender)
+    props = bpy.types.Keyframe.bl_rna.properties
+    return [(name, props[name].enum_items[item].value)
+            for name, item in KEY_ENUMS if name in props]
 
 # ==========================================================================
-#   Creates a list containing the rotations of a bone
-#   rot[i] equals the i+1th frame of animation
-#   "action" is a blender Action, "bonename" is a string
+#   Writes keyframes at frames 1 to len(values) of an FCurve in bulk
+#   Inserting keys one at a time makes Blender sort and recalculate the
+#   handles after every key, here the keyframe buffer is resized once,
+#   filled with foreach_set and the handles are recalculated at the end
+#   Keys on other frames are kept as they are. A key already on one of the
+#   frames only gets its value replaced, its handles move with it and it
+#   keeps its handle types and interpolation (like keyframe_points.insert
+#   with 'REPLACE'), other frames get AUTO_CLAMPED Bezier keys
+#   "fc" is a blender FCurve and "values" a list of floats
 # ==========================================================================
 
 
-def listRotation(action, bonename):
-    rot = []
-    if bonename[-3:] == "001":
-        bonename = bonename[:-4]
-    for i in range(1, int(action.fcurves[0].range()[1]) + 1):
-        rot.append(get_rotation(action, bonename, i))
-    return rot
+def writeKeyframes(fc, values):
+    keys = fc.keyframe_points
+    count = len(keys)
+    enums = keyEnums()
+
+    props = {}
+    for name in KEY_VECTORS:
+        props[name] = empty(2 * count, dtype=float32)
+        keys.foreach_get(name, props[name])
+        props[name] = props[name].reshape(-1, 2)
+    for name, default in enums:
+        props[name] = empty(count, dtype=int32)
+        keys.foreach_get(name, props[name])
+
+    times, old = props["co"][:, 0], props["co"][:, 1]
+    values = array(values, dtype=float32).reshape(-1)
+    frames = arange(1, len(values) + 1)
+    replaced = (times >= 1) & (times <= len(values)) & (times == floor(times))
+
+    # Existing key on every frame (the last one for duplicates), -1 if none
+    source = full(len(values), -1)
+    source[times[replaced].astype(int) - 1] = nonzero(replaced)[0]
+    has = source >= 0
+    src = source[has]
+
+    new = {}
+    new["co"] = empty((len(values), 2), dtype=float32)
+    new["co"][:, 0] = frames
+    new["co"][:, 1] = values
+    for name in KEY_VECTORS[1:]:
+        new[name] = new["co"].copy()
+        new[name][has] = props[name][src]
+        new[name][has, 1] += values[has] - old[src]
+    for name, default in enums:
+        new[name] = full(len(values), default, dtype=int32)
+        new[name][has] = props[name][src]
+
+    keep = ~replaced
+    order = argsort(concatenate((times[keep], frames)), kind="mergesort")
+    total = len(order)
+
+    if total > count:
+        keys.add(total - count)
+    while len(keys) > total:
+        keys.remove(keys[len(keys) - 1], fast=True)
+
+    for name in props:
+        merged = concatenate((props[name][keep], new[name]))[order]
+        keys.foreach_set(name, merged.reshape(-1))
+    fc.update()
 
 # ==========================================================================
 #   Creates new rotation FCurves
 #   "action" is a blender Action, "bonename" is a string and
-#   "rot" is a list of vectors
+#   "rot" is a list of vectors or a frames*3 array
 #	FCurves are guarenteed to not exist if the model is joined for the first time
 # ==========================================================================
 
 
 def addRotation(action, bonename, rot):
     data_path = 'pose.bones["%s"].rotation_euler' % (bonename)
-    c0 = action.fcurves.new(data_path, 0)
-    c1 = action.fcurves.new(data_path, 1)
-    c2 = action.fcurves.new(data_path, 2)
+    rot = array(rot, dtype=float).reshape(-1, 3)
 
-    c0k = c0.keyframe_points
-    c1k = c1.keyframe_points
-    c2k = c2.keyframe_points
-
-    x = []
-    y = []
-    z = []
-
-    # Separate x, y, z values
-    for i in range(len(rot)):
-        x.append(rot[i][0])
-        y.append(rot[i][1])
-        z.append(rot[i][2])
-
-    for i in range(1, len(x)+1):
-        c0k.insert(i, x[i-1])
-        c1k.insert(i, y[i-1])
-        c2k.insert(i, z[i-1])
+    for axis in range(3):
+        writeKeyframes(action.fcurves.new(data_path, axis), rot[:, axis])
 
 
 # ==========================================================================
@@ -162,52 +218,51 @@ def addRotation(action, bonename, rot):
 # Process rotA and rotB
 #   rotA, rotB = applyDTW(rotA, rotB)
 #
+# The hand and body takes are roughly synchronized, so a band is enough
+#   rotA, rotB = applyDTW(rotA, rotB, window=60)
+#
+# For takes of several minutes use the approximation instead
+#   rotA, rotB = applyDTW(rotA, rotB, method="fastdtw", radius=10)
+#
 # Replace originals
 #   replaceRotation(action1, bodyBone, rotA)
 #   replaceRotation(action2, handBone, rotB)
 #
 # 	It will be necessary to compare every joint on the body to ensure the
 #	number of frames is consistent across every FCurve
+#
+# applyJointDTW does this with a single alignment for all the bones
+#   bones = [b + "_" + j for b in bonename for j in joint]
+#   rotA, rotB = applyJointDTW(listRotations(action1, bones),
+#                              listRotations(action2, bones))
+#   for bone, a, b in zip(bones, rotA, rotB):
+#       replaceRotation(action1, bone, a)
+#       replaceRotation(action2, bone, b)
+#
+# When the bones really need their own alignment, dtw.align_batch runs them
+# on a process pool (outside of Blender's main thread)
+#   pairs = dict((b, (listRotation(action1, b), listRotation(action2, b)))
+#                for b in bones)
+#   for bone, (a, b) in align_batch(pairs).items():
+#       replaceRotation(action1, bone, a)
+#       replaceRotation(action2, bone, b)
 # ==========================================================================
 
 # ==========================================================================
 #   Replaces the existing rotation FCurves with the new computed rotations
 #   "action" is a blender Action, "bonename" is a string and
-#   "rot" is a list of vectors
+#   "rot" is a list of vectors or a frames*3 array
 #	This function was replaced by addRotation for the demo but can still be used
 # 	wrt interpolation using the DTW algorithm
 # ==========================================================================
 def replaceRotation(action, bonename, rot):
     data_path = 'pose.bones["%s"].rotation_euler' % (bonename)
-    x = []
-    y = []
-    z = []
-    # Separate x, y, z values
-    for i in range(len(rot)):
-        x.append(rot[i][0])
-        y.append(rot[i][1])
-        z.append(rot[i][2])
+    rot = array(rot, dtype=float).reshape(-1, 3)
 
     # Obtain curves of interest
     for curve in action.fcurves:
         if curve.data_path == data_path:
-            if curve.array_index == 0:
-                c0 = curve
-            elif curve.array_index == 1:
-                c1 = curve
-            elif curve.array_index == 2:
-                c2 = curve
-
-        # Access keyframes
-    c0k = c0.keyframe_points
-    c1k = c1.keyframe_points
-    c2k = c2.keyframe_points
-
-    # Replace existing keyframes with new ones
-    for i in range(1, len(x)+1):
-        c0k.insert(i, x[i-1], {'REPLACE'})
-        c1k.insert(i, y[i-1], {'REPLACE'})
-        c2k.insert(i, z[i-1], {'REPLACE'})
+            writeKeyframes(curve, rot[:, curve.array_index])
 
 # ==========================================================================
 #   Creates the final curve based on determined path
@@ -227,18 +282,93 @@ def match(curve, path):
 #   Primarily interested in Path for the time being
 #   Uses it to generate the new rotations
 #   "curveA", "curveB" are a list of vectors
+#   "window" limits how far the alignment may drift from the diagonal,
+#   an int radius in frames (see dtw.py), None searches every pair of frames
+#   "method" is "dtw" for the exact alignment, "linear" for the same
+#   alignment in linear memory (no cost matrix) or "fastdtw" for the linear
+#   time approximation, which searches "radius" frames around a coarse path
 # ==========================================================================
 
 
-def applyDTW(curveA, curveB):
-    dist, cost, path = dtw(curveA, curveB)
+def applyDTW(curveA, curveB, window=None, method="dtw", radius=1):
+    path = warp_path(curveA, curveB, method, window, radius)
     curveA = match(curveA, path[0])
     curveB = match(curveB, path[1])
     return curveA, curveB
 
 # ==========================================================================
+#   Aligns several bones at once with a single shared path
+#   Every bone keeps the same number of frames after the alignment
+#   "curvesA", "curvesB" are lists of rotation curves (one per bone, e.g.
+#   from listRotations), the other arguments are the same as applyDTW
+#   Returns the aligned curves as frames*3 arrays in the same order
+# ==========================================================================
 
 
+def applyJointDTW(curvesA, curvesB, window=None, method="dtw", radius=1):
+    stackA = stack_curves(curvesA)
+    stackB = stack_curves(curvesB)
+    path = warp_path(stackA, stackB, method, window, radius)
+
+    # One fancy index per side, the bones are views into the result
+    stackA = stackA[path[0]]
+    stackB = stackB[path[1]]
+    curvesA = [stackA[:, 3*k:3*k+3] for k in range(len(curvesA))]
+    curvesB = [stackB[:, 3*k:3*k+3] for k in range(len(curvesB))]
+    return curvesA, curvesB
+
+# ==========================================================================
+#   Rotations of several bones as frames*3 arrays, see listRotation
+#   "action" is a blender Action, "bonenames" is a list of strings
+# ==========================================================================
+
+
+def listRotations(action, bonenames):
+    sampler = RotationSampler(action)
+    return [sampler.sample(b) for b in bonenames]
+
+# ==========================================================================
+#   Rest pose of Blender edit bones as a retarget.Skeleton
+#   "edit_bones" are the edit bones of an armature in edit mode
+# ==========================================================================
+
+
+def readSkeleton(edit_bones):
+    bones = BoneIndex(edit_bones)
+    index = dict((name, c) for c, name in enumerate(bones.names))
+    parents = [index[bones.parent(name)] if bones.parent(name) else -1
+               for name in bones.names]
+    return Skeleton(bones.names, parents,
+                    [tuple(bones[name].head) for name in bones.names],
+                    [tuple(bones[name].tail) for name in bones.names],
+                    [bones[name].use_connect for name in bones.names])
+
+# ==========================================================================
+#   Applies a retarget.Skeleton back to the edit bones
+#   Bones missing from the skeleton are deleted, the others get the
+#   skeleton's parent, head, tail and use_connect (parents first)
+# ==========================================================================
+
+
+def writeSkeleton(edit_bones, skeleton):
+    bones = BoneIndex(edit_bones)
+    for name in bones.names:
+        if name not in skeleton:
+            edit_bones.remove(bones[name])
+
+    for name in skeleton.names:
+        parent = skeleton.parent(name)
+        bones[name].parent = bones[parent] if parent else None
+
+    roots = [name for name in skeleton.names if skeleton.parent(name) is None]
+    for root in roots:
+        for name in [root] + skeleton.childrenRecursive(root):
+            c = skeleton.index[name]
+            bone = bones[name]
+            bone.use_connect = skeleton.connected[c]
+            bone.head = Vector(skeleton.heads[c])
+            bone.tail = Vector(skeleton.tails[c])
+
 if __name__ == "__main__":
     obj = bpy.data.objects
     body = obj[0]  # Assumes this returns the body bvh
@@ -254,73 +384,19 @@ if __name__ == "__main__":
     # Re-select the object, for some reason it doesn't seem to work otherwise
     body = obj[0]
 
-    # Identify marker bones: Names can be changed to accomodate the BVH files imported
+    # Attach the hands (see retarget.attachSkeleton): marker bones names can
+    # be changed to accomodate the BVH files imported
     # Using the provided leap_reader script, the hands will have the names "LeftHand" and "RightHand"
     # The BVH files we used (from
     # https://sites.google.com/a/cgspeed.com/cgspeed/motion-capture/daz-friendly-release)
     # used the naming conventions "lHand", and "rHand"
-    for bone in body.data.edit_bones:
-    if bone.name == "lHand":
-        blh = bone
-    if bone.name == "LeftHand":
-        lh = bone
-    if bone.name == "rHand":
-        brh = bone
-    if bone.name == "RightHand":
-        rh = bone
-
-    # Assigns the parents of the bones
-    rh.parent = brh
-    lh.parent = blh
-
-    # List used to log the length of each bone in the hand (initially)
-    # This step is necessary now because the hand is attached using
-    # "bone.use_connect = True" which moves the bone automatically, and warps
-    # the length of the finger
-    vecs = []
-
-    # The BVH files we used contained fingers (but no adequate hand animation)
-    # This section delets all the fingers that came with the model (assuming naming conventions such as "lThumb", "rThumb", etc)
-    # Also, calculate the length of the finger if it is part of the imported
-    # BVH
-    for child in blh.children_recursive:
-        if child.name[:1] == "l":
-            body.data.edit_bones.remove(child)
-        else:
-            vecs.append((child.name, child.tail-child.head))
-
-    for child in brh.children_recursive:
-        if child.name[:1] == "r":
-            body.data.edit_bones.remove(child)
-        else:
-            vecs.append((child.name, child.tail-child.head))
-
-    # Connect the root of the hand BVHs to the body BVH and set it's length
-    # accordingly
-    vec = [v[1] for i, v in enumerate(vecs) if v[0] == lh.name]
-    vec = vec[0]
-    lh.use_connect = True
-    lh.tail = lh.head + vec
-
-    vec = [v[1] for i, v in enumerate(vecs) if v[0] == rh.name]
-    vec = vec[0]
-    rh.use_connect = True
-    rh.tail = rh.head + vec
-
-    # Connect each bone to the parent's location, and then adjust the length accordingly
-    # This essentially moves the hand to the body while keeping the
-    # orientation and scale
-    for bone in lh.children_recursive:
-        bone.use_connect = True
-        vec = [v[1] for i, v in enumerate(vecs) if v[0] == bone.name]
-        vec = vec[0]
-        bone.tail = bone.head + vec
-
-    for bone in rh.children_recursive:
-        bone.use_connect = True
-        vec = [v[1] for i, v in enumerate(vecs) if v[0] == bone.name]
-        vec = vec[0]
-        bone.tail = bone.head + vec
+    # The hands are parented to the body's hands, the fingers that came with
+    # the model are deleted (assuming naming conventions such as "lThumb",
+    # "rThumb", etc) and every hand bone is connected to its parent keeping
+    # the length it had in the imported BVH, which moves the hand to the body
+    skeleton = readSkeleton(body.data.edit_bones)
+    attachSkeleton(skeleton, ("lHand", "rHand"), ("LeftHand", "RightHand"))
+    writeSkeleton(body.data.edit_bones, skeleton)
 
     # Actions contain the animation data
     # 'left' and 'right' are the names of the BVH files for the left and right hands respectively
@@ -341,6 +417,10 @@ if __name__ == "__main__":
         "Intermediate.001",
         "Distal.001"]
 
+    # Index the hand FCurves once for all the bones
+    handSampler1 = RotationSampler(handActions1)
+    handSampler2 = RotationSampler(handActions2)
+
     # Adds the existing animation on the FCurve to the main BVH
     for b in bonename:
         for j in joint:
@@ -348,7 +428,7 @@ if __name__ == "__main__":
             # Using the Leap_reader script, the bone names will be identical
             # Blender will automatically rename the bones to end in ".001"
             if bone[-3:] == "001":
-                rot = listRotation(handActions2, bone)
+                rot = handSampler2.sample(bone)
             else:
-                rot = listRotation(handActions1, bone)
+                rot = handSampler1.sample(bone)
             addRotation(bodyActions, bone, rot)
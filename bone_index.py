@@ -0,0 +1,75 @@
+# ==========================================================================
+# Name lookups on the bones of an armature
+# Blender's bone collections and children_recursive are walked every time
+# they are used; BoneIndex reads the bones once and then answers bone,
+# rest vector, parent and children lookups by name from dictionaries
+# Works with bones, edit bones or anything with name, parent, head, tail
+# and length
+# ==========================================================================
+
+
+class BoneIndex(object):
+
+    # bones = the bones of one armature, e.g. armature.bones or edit_bones
+    # keepBones = False only keeps plain data (names, parents, vectors and
+    # lengths): Blender reallocates its bones when the armature is edited,
+    # so an index that outlives the edit must not hold on to them
+    def __init__(self, bones, keepBones=True):
+        bones = list(bones)
+        self.names = [bone.name for bone in bones]
+        self.bones = {}
+        if keepBones:
+            self.bones = dict((bone.name, bone) for bone in bones)
+        self.lengths = dict((bone.name, bone.length) for bone in bones)
+
+        # Rest vector (tail - head) when the index is built, so it is kept
+        # even if the bone is moved afterwards
+        self.vectors = dict((bone.name, bone.tail - bone.head)
+                            for bone in bones)
+
+        self.parents = dict((bone.name, bone.parent.name
+                             if bone.parent is not None else None)
+                            for bone in bones)
+        self.children = dict((name, []) for name in self.names)
+        for name in self.names:
+            parent = self.parents[name]
+            if parent is not None:
+                self.children[parent].append(name)
+        self.descendants = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.parents
+
+    def __getitem__(self, name):
+        return self.bones[name]
+
+    def get(self, name, default=None):
+        return self.bones.get(name, default)
+
+    def vector(self, name):
+        return self.vectors[name]
+
+    def length(self, name):
+        return self.lengths[name]
+
+    def parent(self, name):
+        return self.parents[name]
+
+    # Names of every bone below name, parents before their children
+    def childrenRecursive(self, name):
+        if name not in self.descendants:
+            bones = []
+            stack = list(reversed(self.children[name]))
+            while stack:
+                child = stack.pop()
+                bones.append(child)
+                stack.extend(reversed(self.children[child]))
+            self.descendants[name] = bones
+        return self.descendants[name]
+
+    # Names of the roots of the armature
+    def roots(self):
+        return [name for name in self.names if self.parents[name] is None]
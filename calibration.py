@@ -0,0 +1,175 @@
+# ==========================================================================
+# Per-subject hand calibration from whole CSV takes
+# The rest pose of a BVH comes from a single frame (the first one in
+# leap_reader.py and csv2bvh.py), so one noisy LEAP frame changes the size
+# of the hand. Here every frame of a subject's takes is streamed, the 20
+# finger bone lengths are measured per frame and reduced with a median or a
+# trimmed mean. The result is kept in a small JSON file per subject that
+# Scaler (scaling.py), csv2bvh.py and leap_reader.py read back
+# Usage: python calibration.py [-d DIR] [--method median|trimmed] subject
+#        takes.csv [...]
+# ==========================================================================
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+from leap_data import handedness, read_chunks
+from proportions import FINGER_BONES, leapHandLength
+
+# Folder of the calibration files, one <subject>.json per subject
+CALIBRATION_DIR = "calibration"
+
+METHODS = ("median", "trimmed")
+
+# Columns read from the takes, every finger bone's start then end
+COLUMNS = [b + " Start" for b in FINGER_BONES] + \
+    [b + " End" for b in FINGER_BONES]
+
+
+# ==========================================================================
+#   Length of the 20 finger bones in every frame of a CSV recording
+#   Only the Start/End columns are parsed, block by block
+#   Returns a (frames, 20) float32 array, see proportions.csvBoneLengths
+# ==========================================================================
+def streamBoneLengths(filename, size=4096):
+    blocks = []
+    for block in read_chunks(filename, COLUMNS, size):
+        ends = block.reshape(len(block), 2, len(FINGER_BONES), 3)
+        blocks.append(np.sqrt(((ends[:, 1] - ends[:, 0]) ** 2)
+                              .sum(axis=2)).astype(np.float32))
+    if not blocks:
+        return np.zeros((0, len(FINGER_BONES)), np.float32)
+    return np.concatenate(blocks)
+
+
+# ==========================================================================
+#   Robust length of every bone over all the frames
+#   "lengths" is (frames, bones), frames with NaNs are left out
+#   method = "median" or "trimmed" (mean of the frames left after cutting
+#   "trim" of them at both ends of every bone)
+# ==========================================================================
+def robustLengths(lengths, method="median", trim=0.1):
+    lengths = np.asarray(lengths, dtype=float)
+    lengths = lengths[np.isfinite(lengths).all(axis=1)]
+    if len(lengths) == 0:
+        raise ValueError("no frames to calibrate from")
+
+    if method == "median":
+        return np.median(lengths, axis=0)
+    if method == "trimmed":
+        cut = int(len(lengths) * trim)
+        ordered = np.sort(lengths, axis=0)
+        return ordered[cut:len(ordered) - cut].mean(axis=0)
+    raise ValueError("Unknown calibration method %r" % (method))
+
+
+def _sources(filenames):
+    return dict((os.path.abspath(f), os.path.getmtime(f)) for f in filenames)
+
+
+# ==========================================================================
+#   Calibrate from a subject's takes
+#   The hand of every take is "hand" or guessed from its name (left_*.csv)
+#   Returns the calibration: {"hands": {"left": {"bones", "lengths",
+#   "hand_length", "frames"}, ...}, "hand", "method", "trim", "sources"}
+# ==========================================================================
+def calibrate(filenames, hand=None, method="median", trim=0.1, size=4096):
+    takes = {}
+    for filename in filenames:
+        lengths = streamBoneLengths(filename, size)
+        takes.setdefault(hand or handedness(filename), []).append(lengths)
+
+    hands = {}
+    for side, lengths in takes.items():
+        lengths = np.concatenate(lengths)
+        robust = robustLengths(lengths, method, trim)
+        hands[side] = {"bones": FINGER_BONES,
+                       "lengths": robust.tolist(),
+                       "hand_length": float(leapHandLength(robust)),
+                       "frames": len(lengths)}
+
+    return {"hands": hands, "hand": hand, "method": method, "trim": trim,
+            "sources": _sources(filenames)}
+
+
+def calibrationFile(subject, folder=CALIBRATION_DIR):
+    return os.path.join(folder, subject + ".json")
+
+
+def loadCalibration(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def saveCalibration(filename, calibration):
+    folder = os.path.dirname(filename)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    # Write next to it first so a reader never sees half a file
+    with open(filename + ".tmp", "w") as f:
+        json.dump(calibration, f, indent=1, sort_keys=True)
+    if os.path.exists(filename):
+        os.remove(filename)
+    os.rename(filename + ".tmp", filename)
+
+
+# ==========================================================================
+#   Calibration of a subject, computed once and then read from its file
+#   It is computed again when the takes, their modification times, the
+#   hand or the method change
+# ==========================================================================
+def subjectCalibration(subject, filenames, hand=None, method="median",
+                       trim=0.1, folder=CALIBRATION_DIR):
+    filename = calibrationFile(subject, folder)
+    if os.path.exists(filename):
+        calibration = loadCalibration(filename)
+        if calibration.get("sources") == _sources(filenames) and \
+                calibration.get("hand", False) == hand and \
+                calibration.get("method") == method and \
+                calibration.get("trim") == trim:
+            return calibration
+
+    calibration = calibrate(filenames, hand, method, trim)
+    saveCalibration(filename, calibration)
+    return calibration
+
+
+# ==========================================================================
+#   Calibrated lengths of one hand in FINGER_BONES order, None if the
+#   calibration has no such hand
+# ==========================================================================
+def handLengths(calibration, hand):
+    if hand not in calibration["hands"]:
+        return None
+    return np.array(calibration["hands"][hand]["lengths"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Calibrate a subject's hands from Leap CSV takes")
+    parser.add_argument("subject", help="name of the calibration file")
+    parser.add_argument("files", nargs="+", help="CSV recordings")
+    parser.add_argument("-d", "--dir", default=CALIBRATION_DIR,
+                        help="folder of the calibration files")
+    parser.add_argument("--method", choices=METHODS, default="median")
+    parser.add_argument("--trim", type=float, default=0.1,
+                        help="fraction cut at each end by --method trimmed")
+    parser.add_argument("--hand", choices=["left", "right"],
+                        help="hand of every file (default: from the name)")
+    args = parser.parse_args(argv)
+
+    calibration = subjectCalibration(args.subject, args.files, args.hand,
+                                     args.method, args.trim, args.dir)
+    print(calibrationFile(args.subject, args.dir))
+    for side, values in sorted(calibration["hands"].items()):
+        print("%s: hand length %g from %d frames"
+              % (side, values["hand_length"], values["frames"]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
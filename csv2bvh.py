@@ -0,0 +1,219 @@
+# ==========================================================================
+# Convert Leap CSV recordings (leap_csv.cpp) to BVH without the device
+# Usage: python csv2bvh.py [-j JOBS] [-o OUTDIR] [--hand left|right] *.csv
+#
+# The CSV has no bone bases, so they are rebuilt from the recorded data:
+# the bone's z axis is its "Direction" column (pointing to the base, like
+# the LEAP basis) and its up axis is the palm's up vector (minus the
+# normal from "Hand Pitch", "Hand Roll" and "Hand Yaw") made perpendicular
+# to it. The Euler angles then follow BVHListener.rotation_to_euler and the
+# BVH has the same skeleton and channels as leap_reader.py
+# Files are converted in parallel on a process pool, block by block
+# ==========================================================================
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from leap_data import FINGERS, BONES, INDEX, VECTOR_INDEX, handedness, \
+    read_chunks
+from calibration import loadCalibration, handLengths
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "leap_bvh"))
+from bvh import createHeader, BVHWriter
+from euler import bases_to_matrices, rotations_to_euler
+
+# Joint names used by leap_reader.py (it calls the "Middle" bone
+# "Intermediate")
+BVH_BONES = ['Metacarpal', 'Proximal', 'Intermediate', 'Distal']
+
+
+def _vectors(block, names):
+    cols = np.array([VECTOR_INDEX[v] for v in names])
+    return block[:, cols[:, None] + np.arange(3)]
+
+
+def _unit(v):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        v = v / np.linalg.norm(v, axis=-1)[..., None]
+    return np.nan_to_num(v)
+
+
+# ==========================================================================
+#   Palm normal of every frame, rebuilt from the hand pitch, yaw and roll
+#   (degrees, as written by leap_csv.cpp with the LEAP Vector conventions:
+#   pitch = atan2(y, -z), yaw = atan2(x, -z) of the hand direction and
+#   roll = atan2(x, -y) of the normal, which is perpendicular to it)
+# ==========================================================================
+def palmNormals(block):
+    pitch, roll, yaw = np.radians(block[:, [INDEX['Hand Pitch'],
+                                            INDEX['Hand Roll'],
+                                            INDEX['Hand Yaw']]]).T
+    direction = _unit(np.stack([np.tan(yaw), np.tan(pitch),
+                                -np.ones(len(block))], axis=1))
+    nx, ny = np.sin(roll), -np.cos(roll)
+    nz = -(nx * direction[:, 0] + ny * direction[:, 1]) / direction[:, 2]
+    return _unit(np.stack([nx, ny, nz], axis=1))
+
+
+# ==========================================================================
+#   Joint names and offsets of the HIERARCHY, from the first frame
+#   lengths = calibrated length of the 20 bones (see calibration.py), the
+#   first frame then only gives their direction
+# ==========================================================================
+def hierarchy(row, is_left, lengths=None):
+    joints = [" ".join([f, b]) for f in FINGERS for b in BVH_BONES]
+    joints.insert(0, ("Left" if is_left else "Right") + "Hand")
+
+    bones = [" ".join([f, b]) for f in FINGERS for b in BONES]
+    start = _vectors(row[None], [b + " Start" for b in bones])[0]
+    end = _vectors(row[None], [b + " End" for b in bones])[0]
+    vectors = end - start
+    if lengths is not None:
+        vectors = _unit(vectors) * np.asarray(lengths)[:, None]
+    offsets = [" ".join("%g" % i for i in v)
+               for v in vectors.tolist()]
+    offsets.insert(0, "0.0 0.0 0.0")
+    return joints, offsets
+
+
+# ==========================================================================
+#   Motion lines of a block of frames, see BVHListener.on_frame
+# ==========================================================================
+def motion(block, is_left):
+    bones = [" ".join([f, b]) for f in FINGERS for b in BONES]
+
+    # LEAP bone basis: z along the bone towards its base, y up, x to the
+    # side (mirrored for left hands)
+    z = _unit(_vectors(block, [b + " Direction" for b in bones]))
+    up = -palmNormals(block)[:, None, :]
+    y = _unit(up - (up * z).sum(axis=2)[..., None] * z)
+    x = np.cross(y, z)
+    if is_left:
+        x = -x
+
+    bases = np.concatenate([x, y, z], axis=2).reshape(-1, 9)
+    angles = rotations_to_euler(bases_to_matrices(bases), flip_x=is_left)
+    angles = angles.reshape(len(block), len(bones), 3).tolist()
+
+    hands = block[:, [INDEX['Hand Roll'], INDEX['Hand Pitch'],
+                      INDEX['Hand Yaw']]].tolist()
+    lines = []
+    for hand, frame in zip(hands, angles):
+        # Thumb's have no Metacarpal bone
+        line = "0 0 0 %s %s %s 0 0 0 " % tuple(hand)
+        line += "".join("%s %s %s " % tuple(a) for a in frame[1:])
+        lines.append(line)
+    return lines
+
+
+# ==========================================================================
+#   Convert one CSV file, returns (output file, number of frames)
+#   The output is removed when the conversion fails
+#   lengths = calibrated bone lengths of the hand, see hierarchy
+# ==========================================================================
+def convert(filename, output=None, hand=None, size=4096, lengths=None):
+    is_left = (hand or handedness(filename)) == "left"
+    if output is None:
+        output = os.path.splitext(filename)[0] + ".bvh"
+
+    writer = None
+    first = last = None
+    try:
+        for block in read_chunks(filename, size=size):
+            if writer is None:
+                writer = BVHWriter(output)
+                writer.writeHeader(createHeader(*hierarchy(block[0], is_left,
+                                                              lengths)))
+                first = block[0, INDEX['Timestamp']]
+            for line in motion(block, is_left):
+                writer.writeFrame(line)
+            last = block[-1, INDEX['Timestamp']]
+    except Exception:
+        # Don't leave half a BVH behind
+        if writer is not None:
+            writer.file.close()
+            os.remove(output)
+        raise
+
+    if writer is None:
+        raise ValueError("%s has no frames" % filename)
+
+    # Timestamps are in microseconds
+    frames = writer.frames
+    frame_time = (last - first) / 1e6 / (frames - 1) if frames > 1 else 0
+    writer.close(frame_time)
+    return output, frames
+
+
+def _job(args):
+    return convert(*args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert Leap CSV recordings to BVH")
+    parser.add_argument("files", nargs="+", help="CSV recordings")
+    parser.add_argument("-o", "--outdir",
+                        help="folder of the BVH files (default: next to "
+                             "the CSV files)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of processes (default: every core)")
+    parser.add_argument("--hand", choices=["left", "right"],
+                        help="hand of every file (default: from the name)")
+    parser.add_argument("-c", "--calibration",
+                        help="calibration file of the subject (see "
+                             "calibration.py) for the bone lengths")
+    args = parser.parse_args(argv)
+
+    if args.outdir and not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+
+    calibration = None
+    if args.calibration:
+        calibration = loadCalibration(args.calibration)
+
+    jobs = []
+    for filename in args.files:
+        output = None
+        if args.outdir:
+            output = os.path.join(args.outdir, os.path.splitext(
+                os.path.basename(filename))[0] + ".bvh")
+        lengths = None
+        if calibration:
+            lengths = handLengths(calibration,
+                                  args.hand or handedness(filename))
+        jobs.append((filename, output, args.hand, 4096, lengths))
+
+    start = time.time()
+    total = failed = 0
+    with ProcessPoolExecutor(args.jobs) as pool:
+        futures = dict((pool.submit(_job, job), job[0]) for job in jobs)
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                output, frames = future.result()
+            except Exception as e:
+                failed += 1
+                print("[%d/%d] %s failed: %s"
+                      % (done, len(jobs), futures[future], e),
+                      file=sys.stderr)
+                continue
+            total += frames
+            elapsed = time.time() - start
+            print("[%d/%d] %s (%d frames) %.1f files/s %.0f frames/s"
+                  % (done, len(jobs), output, frames, done / elapsed,
+                     total / elapsed))
+
+    elapsed = time.time() - start
+    print("Converted %d files (%d failed), %d frames in %.2fs"
+          % (len(jobs) - failed, failed, total, elapsed))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,602 @@
+# ==========================================================================
+# Dynamic Time Warping used to align rotation curves
+# This module only depends on NumPy so it can be used outside of Blender
+# attachment.py imports it to align the body and hand animations
+# ==========================================================================
+
+from concurrent.futures import ProcessPoolExecutor
+
+from numpy import array, zeros, empty, full, argmin, inf, arange, \
+    absolute, sqrt, minimum, maximum, floor, ceil, clip, cumsum, integer, \
+    concatenate, where, int8, int32, hstack
+
+# ==========================================================================
+#   DTW implementation courtesy of Pierre Rouanet:
+#   http://github.com/pierre-rouanet/dtw
+#   See examples that he posts
+#   The cost matrix and accumulation are vectorized with NumPy, the
+#   original per-cell loops are kept for custom distance functions
+# ==========================================================================
+
+# Norm orders understood by the vectorized cost matrix
+NORMS = {'l1': 1, 'l2': 2}
+
+# Moves recorded during the accumulation, followed by the traceback
+DIAG, UP, LEFT = 0, 1, 2
+
+
+def _as_frames(x):
+    x = array(x, dtype=float)
+    if len(x.shape) == 1:
+        x = x.reshape(-1, 1)
+    return x
+
+
+def cost_matrix(x, y, dist='l1'):
+    """ Computes the local cost between every frame of x and y.
+
+    :param array x: N1*M array
+    :param array y: N2*M array
+    :param dist: 'l1', 'l2' or a function used as cost measure
+
+    Returns an N1*N2 array. The named norms are computed with one broadcast
+    per column, a function is called once per pair of frames (slow).
+
+    """
+    x = _as_frames(x)
+    y = _as_frames(y)
+    r, c = len(x), len(y)
+
+    if callable(dist):
+        C = empty((r, c))
+        for i in range(r):
+            for j in range(c):
+                C[i, j] = dist(x[i], y[j])
+        return C
+
+    if dist not in NORMS:
+        raise ValueError("Unknown distance %r, use one of %s or a function"
+                         % (dist, sorted(NORMS)))
+
+    # Summing one column at a time avoids an N1*N2*M temporary
+    C = zeros((r, c))
+    for k in range(x.shape[1]):
+        d = x[:, k, None] - y[None, :, k]
+        if NORMS[dist] == 1:
+            C += absolute(d)
+        else:
+            C += d * d
+
+    if NORMS[dist] == 2:
+        sqrt(C, out=C)
+    return C
+
+
+def _steps(diag, up, left):
+    # Move taken into each cell, ties are broken like argmin over
+    # (diag, up, left) in the traceback
+    return where((diag <= up) & (diag <= left), DIAG,
+                 where(up <= left, UP, LEFT)).astype(int8)
+
+
+def _accumulate(C):
+    # Fill the accumulated cost along anti-diagonals: every cell on diagonal
+    # i + j only depends on the two previous diagonals, so a whole diagonal
+    # is computed at once and the result matches the cell by cell loop
+    # The move into every cell is recorded so the traceback is an index walk
+    r, c = C.shape
+    D = zeros((r + 1, c + 1))
+    D[0, 1:] = inf
+    D[1:, 0] = inf
+    steps = empty((r, c), dtype=int8)
+
+    for d in range(r + c - 1):
+        i = arange(max(0, d - c + 1), min(d, r - 1) + 1)
+        j = d - i
+        diag, up, left = D[i, j], D[i, j + 1], D[i + 1, j]
+        D[i + 1, j + 1] = C[i, j] + minimum(minimum(diag, up), left)
+        steps[i, j] = _steps(diag, up, left)
+    return D[1:, 1:], steps
+
+
+def dtw(x, y, dist='l1', window=None):
+    """ Computes the DTW of two sequences.
+
+    :param array x: N1*M array
+    :param array y: N2*M array
+    :param dist: 'l1' (default), 'l2' or a function used as cost measure
+    :param window: None for the full matrix, an int radius for a
+        Sakoe-Chiba band or a (lo, hi) pair from one of the window functions
+
+    Returns the minimum distance, the accumulated cost matrix and the wrap path.
+    With a window the matrix is banded: row i holds columns lo[i] to hi[i] - 1.
+
+    """
+    if window is not None:
+        return _dtw_banded(x, y, dist, window)
+
+    D, steps = _accumulate(cost_matrix(x, y, dist))
+
+    dist = D[-1, -1] / sum(D.shape)
+
+    return dist, D, _trackeback(D, steps)
+
+
+def _trackeback(D, steps=None):
+    # The path is written backwards into preallocated arrays (it is at most
+    # N1 + N2 - 1 long) and the used tail is returned. Once the path reaches
+    # the first row or column it walks along it to (0, 0)
+    if steps is not None:
+        return _walk(steps, zeros(len(steps), dtype=int), D.shape[1])
+
+    i, j = D.shape[0] - 1, D.shape[1] - 1
+    p = empty(i + j + 1, dtype=int)
+    q = empty(i + j + 1, dtype=int)
+    k = i + j
+    p[k], q[k] = i, j
+    while (i > 0 or j > 0):
+        if i == 0:
+            j = j - 1
+        elif j == 0:
+            i = i - 1
+        else:
+            diag, up, left = D[i-1, j-1], D[i-1, j], D[i, j-1]
+            if diag <= up and diag <= left:
+                i = i - 1
+                j = j - 1
+            elif up <= left:
+                i = i - 1
+            else:
+                j = j - 1
+
+        k = k - 1
+        p[k], q[k] = i, j
+
+    return (p[k:], q[k:])
+
+
+def _walk(steps, lo, c):
+    # Follow the recorded moves back from the last cell, row i of steps
+    # starts at column lo[i]
+    lo = lo.tolist()
+    i, j = len(lo) - 1, c - 1
+
+    p = empty(i + j + 1, dtype=int)
+    q = empty(i + j + 1, dtype=int)
+    k = i + j
+    p[k], q[k] = i, j
+    while (i > 0 or j > 0):
+        if i == 0:
+            j = j - 1
+        elif j == 0:
+            i = i - 1
+        else:
+            step = steps.item(i, j - lo[i])
+            if step == DIAG:
+                i = i - 1
+                j = j - 1
+            elif step == UP:
+                i = i - 1
+            else:
+                j = j - 1
+
+        k = k - 1
+        p[k], q[k] = i, j
+
+    return (p[k:], q[k:])
+
+
+# ==========================================================================
+#   Linear memory DTW
+#   dtw_distance() only keeps the current row of the accumulated cost
+#   dtw_path() recovers the warp path with Hirschberg's divide and conquer:
+#   the middle row is crossed where the forward cost from (0, 0) plus the
+#   backward cost from the last cell is smallest, then both halves are solved
+#   on their own. Memory stays O(N2), time is about twice the full DTW
+# ==========================================================================
+
+# Sub-problems this small are solved with the full matrix
+BASE_CELLS = 1 << 16
+
+
+def _cost_row(xi, y, dist):
+    if callable(dist):
+        return array([dist(xi, yj) for yj in y], dtype=float)
+    if dist not in NORMS:
+        raise ValueError("Unknown distance %r, use one of %s or a function"
+                         % (dist, sorted(NORMS)))
+    d = y - xi
+    if NORMS[dist] == 1:
+        return absolute(d).sum(axis=1)
+    return sqrt((d * d).sum(axis=1))
+
+
+def _last_row(x, y, dist):
+    # Accumulated cost of the last row of x, two rows of memory. The
+    # horizontal moves use the same running minimum as _accumulate_banded
+    D = cumsum(_cost_row(x[0], y, dist))
+    for i in range(1, len(x)):
+        C = _cost_row(x[i], y, dist)
+        T = C + minimum(D, concatenate(([inf], D[:-1])))
+        S = cumsum(C)
+        D = minimum.accumulate(T - S) + S
+    return D
+
+
+def dtw_distance(x, y, dist='l1'):
+    """ Computes the DTW distance of two sequences without the cost matrix.
+
+    :param array x: N1*M array
+    :param array y: N2*M array
+    :param dist: 'l1' (default), 'l2' or a function used as cost measure
+
+    Returns the same minimum distance as dtw() using O(N2) memory.
+
+    """
+    x = _as_frames(x)
+    y = _as_frames(y)
+    return _last_row(x, y, dist)[-1] / float(len(x) + len(y))
+
+
+def _hirschberg(x, y, dist, i0, j0, p, q):
+    r, c = len(x), len(y)
+    if r * c <= BASE_CELLS or r < 2:
+        path = _trackeback(*_accumulate(cost_matrix(x, y, dist)))
+        p.extend(path[0] + i0)
+        q.extend(path[1] + j0)
+        return
+
+    m = r // 2 - 1
+    # forward[j]: best path from (0, 0) to (m, j)
+    # backward[j]: best path from (m + 1, j) to the last cell
+    forward = _last_row(x[:m + 1], y, dist)
+    backward = _last_row(x[:m:-1], y[::-1], dist)[::-1]
+
+    # The path leaves row m at (m, j) to (m + 1, j) or (m + 1, j + 1)
+    down = forward + backward
+    diag = forward[:-1] + backward[1:]
+    j = argmin(down)
+    step = 0
+    if diag.size and diag.min() < down[j]:
+        j = argmin(diag)
+        step = 1
+
+    _hirschberg(x[:m + 1], y[:j + 1], dist, i0, j0, p, q)
+    _hirschberg(x[m + 1:], y[j + step:], dist, i0 + m + 1, j0 + j + step,
+                p, q)
+
+
+def dtw_path(x, y, dist='l1'):
+    """ Computes the DTW warp path of two sequences in linear memory.
+
+    :param array x: N1*M array
+    :param array y: N2*M array
+    :param dist: 'l1' (default), 'l2' or a function used as cost measure
+
+    Returns the minimum distance and the wrap path, like dtw() without the
+    accumulated cost matrix.
+
+    """
+    x = _as_frames(x)
+    y = _as_frames(y)
+    p, q = [], []
+    _hirschberg(x, y, dist, 0, 0, p, q)
+    p, q = array(p), array(q)
+
+    dist = _cost_path(x, y, p, q, dist) / float(len(x) + len(y))
+    return dist, (p, q)
+
+
+def _cost_path(x, y, p, q, dist):
+    if callable(dist):
+        return sum(dist(x[i], y[j]) for i, j in zip(p, q))
+    d = x[p] - y[q]
+    if NORMS[dist] == 1:
+        return absolute(d).sum()
+    return sqrt((d * d).sum(axis=1)).sum()
+
+
+# ==========================================================================
+#   Window constrained DTW
+#   A window is a pair of int arrays (lo, hi): row i of the cost matrix is
+#   only computed for columns lo[i] <= j < hi[i]. The cells are stored in a
+#   N1*W array (W the widest row) so memory and time are O(N1*W) instead of
+#   O(N1*N2)
+# ==========================================================================
+
+
+def _window_rows(lo, hi, c):
+    # Clip the window to the matrix and make sure a path can go from
+    # (0, 0) to the last cell: rows only move right and each row starts at
+    # most one column after the previous row ends
+    lo = clip(array(lo, dtype=int), 0, c - 1)
+    hi = clip(array(hi, dtype=int), 1, c)
+    lo[0] = 0
+    hi[-1] = c
+    lo = minimum.accumulate(lo[::-1])[::-1]
+    hi = maximum.accumulate(maximum(hi, lo + 1))
+    hi[:-1] = maximum(hi[:-1], lo[1:])
+    return lo, hi
+
+
+def sakoe_chiba_window(r, c, radius):
+    """ Sakoe-Chiba band of the given radius around the diagonal.
+
+    :param int r: length of the first sequence
+    :param int c: length of the second sequence
+    :param int radius: number of frames allowed away from the diagonal
+
+    Returns the (lo, hi) column bounds of every row.
+
+    """
+    center = arange(r) * (c - 1) / float(max(r - 1, 1))
+    lo = floor(center - radius)
+    hi = ceil(center + radius) + 1
+    return _window_rows(lo, hi, c)
+
+
+def itakura_window(r, c, slope=2.0):
+    """ Itakura parallelogram, the path slope stays between 1/slope and slope.
+
+    :param int r: length of the first sequence
+    :param int c: length of the second sequence
+    :param float slope: maximum local slope of the warp path (> 1)
+
+    Returns the (lo, hi) column bounds of every row.
+
+    """
+    u = arange(r) / float(max(r - 1, 1))
+    vmin = maximum(u / slope, 1 - (1 - u) * slope)
+    vmax = minimum(u * slope, 1 - (1 - u) / slope)
+    lo = floor(clip(vmin, 0, 1) * (c - 1))
+    hi = ceil(clip(vmax, 0, 1) * (c - 1)) + 1
+    return _window_rows(lo, hi, c)
+
+
+def _as_window(window, r, c):
+    if isinstance(window, (int, integer)):
+        return sakoe_chiba_window(r, c, window)
+    lo, hi = window
+    if len(lo) != r or len(hi) != r:
+        raise ValueError("Window has %d rows, expected %d" % (len(lo), r))
+    return _window_rows(lo, hi, c)
+
+
+def banded_cost(x, y, lo, hi, dist='l1'):
+    """ Computes the local cost only inside a window.
+
+    Returns an N1*W array, cells outside of the window are inf.
+
+    """
+    x = _as_frames(x)
+    y = _as_frames(y)
+    r, c = len(x), len(y)
+    width = (hi - lo).max()
+
+    cols = lo[:, None] + arange(width)
+    inside = cols < hi[:, None]
+    cols = minimum(cols, c - 1)
+
+    if callable(dist):
+        C = full((r, width), inf)
+        for i in range(r):
+            for k in range(hi[i] - lo[i]):
+                C[i, k] = dist(x[i], y[lo[i] + k])
+        return C
+
+    if dist not in NORMS:
+        raise ValueError("Unknown distance %r, use one of %s or a function"
+                         % (dist, sorted(NORMS)))
+
+    C = zeros((r, width))
+    for k in range(x.shape[1]):
+        d = x[:, k, None] - y[cols, k]
+        if NORMS[dist] == 1:
+            C += absolute(d)
+        else:
+            C += d * d
+
+    if NORMS[dist] == 2:
+        sqrt(C, out=C)
+    C[~inside] = inf
+    return C
+
+
+def _accumulate_banded(C, lo, hi):
+    # Rows are filled one at a time. The vertical and diagonal moves come
+    # from the previous row, the horizontal moves are a running minimum:
+    # D[j] = min(T[j], D[j-1] + C[j]) is solved with a cumulative sum S of
+    # the row cost as D = minimum.accumulate(T - S) + S
+    r, width = C.shape
+    D = full((r, width), inf)
+    steps = full((r, width), LEFT, dtype=int8)
+
+    n = hi[0] - lo[0]
+    D[0, :n] = cumsum(C[0, :n])
+
+    for i in range(1, r):
+        n = hi[i] - lo[i]
+        cols = arange(lo[i], hi[i])
+        prev_n = hi[i - 1] - lo[i - 1]
+
+        up = full(n, inf)
+        k = cols - lo[i - 1]
+        ok = k < prev_n
+        up[ok] = D[i - 1, k[ok]]
+
+        diag = full(n, inf)
+        k = k - 1
+        ok = (k >= 0) & (k < prev_n)
+        diag[ok] = D[i - 1, k[ok]]
+
+        S = cumsum(C[i, :n])
+        D[i, :n] = minimum.accumulate(C[i, :n] + minimum(up, diag) - S) + S
+
+        left = concatenate(([inf], D[i, :n - 1]))
+        steps[i, :n] = _steps(diag, up, left)
+    return D, steps
+
+
+def _dtw_banded(x, y, dist, window):
+    x = _as_frames(x)
+    y = _as_frames(y)
+    r, c = len(x), len(y)
+
+    lo, hi = _as_window(window, r, c)
+    D, steps = _accumulate_banded(banded_cost(x, y, lo, hi, dist), lo, hi)
+
+    dist = D[-1, c - 1 - lo[-1]] / float(r + c)
+
+    return dist, D, _walk(steps, lo, c)
+
+
+# ==========================================================================
+#   FastDTW (Salvador & Chan): approximate DTW in linear time and memory
+#   Both sequences are halved until they are small, solved exactly, and the
+#   path found at each resolution is projected onto the next finer one where
+#   only a window of "radius" frames around it is searched
+# ==========================================================================
+
+
+def _coarsen(x):
+    # Average pairs of frames, an odd last frame is kept as is
+    n = len(x) // 2 * 2
+    coarse = x[:n].reshape(n // 2, 2, -1).mean(axis=1)
+    if n < len(x):
+        coarse = concatenate((coarse, x[n:]))
+    return coarse
+
+
+def _expand_window(path, r, c, radius):
+    # Every coarse cell covers a 2*2 block of fine cells, the window is the
+    # union of those blocks grown by radius frames in every direction
+    p, q = path
+    lo = full(r, c)
+    hi = zeros(r, dtype=int)
+    for offset in (0, 1):
+        rows = minimum(2 * p + offset, r - 1)
+        minimum.at(lo, rows, 2 * q)
+        maximum.at(hi, rows, 2 * q + 2)
+
+    lo_grown, hi_grown = lo.copy(), hi.copy()
+    for shift in range(1, radius + 1):
+        lo_grown[shift:] = minimum(lo_grown[shift:], lo[:-shift])
+        lo_grown[:-shift] = minimum(lo_grown[:-shift], lo[shift:])
+        hi_grown[shift:] = maximum(hi_grown[shift:], hi[:-shift])
+        hi_grown[:-shift] = maximum(hi_grown[:-shift], hi[shift:])
+
+    return _window_rows(lo_grown - radius, hi_grown + radius, c)
+
+
+def fastdtw(x, y, radius=1, dist='l1'):
+    """ Approximates the DTW of two sequences in O(N) time and memory.
+
+    :param array x: N1*M array
+    :param array y: N2*M array
+    :param int radius: extra frames searched around the projected path,
+        larger is slower but closer to the exact DTW
+    :param dist: 'l1' (default), 'l2' or a function used as cost measure
+
+    Returns the same tuple as dtw() with a window, the accumulated cost matrix
+    is banded around the final path.
+
+    """
+    x = _as_frames(x)
+    y = _as_frames(y)
+    min_size = radius + 2
+
+    if len(x) <= min_size or len(y) <= min_size:
+        return dtw(x, y, dist)
+
+    _, _, path = fastdtw(_coarsen(x), _coarsen(y), radius, dist)
+    window = _expand_window(path, len(x), len(y), radius)
+
+    return _dtw_banded(x, y, dist, window)
+
+
+# ==========================================================================
+#   Alignment entry points used by attachment.py
+# ==========================================================================
+
+METHODS = ('dtw', 'linear', 'fastdtw')
+
+
+def warp_path(x, y, method='dtw', window=None, radius=1, dist='l1'):
+    """ Computes only the warp path of two sequences.
+
+    :param str method: 'dtw' (exact), 'linear' (exact, linear memory) or
+        'fastdtw' (approximate, linear time)
+    :param window: band of the 'dtw' method, see dtw()
+    :param int radius: search radius of the 'fastdtw' method
+
+    Returns the (p, q) index arrays of the path.
+
+    """
+    if method == 'dtw':
+        return dtw(x, y, dist, window)[2]
+    if method == 'linear':
+        return dtw_path(x, y, dist)[1]
+    if method == 'fastdtw':
+        return fastdtw(x, y, radius, dist)[2]
+    raise ValueError("Unknown DTW method %r, use one of %s"
+                     % (method, ', '.join(METHODS)))
+
+
+def stack_curves(curves):
+    """ Stacks the curves of several bones into one multivariate sequence.
+
+    :param list curves: N*3 rotation curves, all with the same frame count
+
+    Returns an N*(3*bones) array, bone k is in columns 3*k to 3*k + 2.
+
+    """
+    curves = [_as_frames(c) for c in curves]
+    frames = set(len(c) for c in curves)
+    if len(frames) != 1:
+        raise ValueError("Curves have different frame counts: %s"
+                         % sorted(frames))
+    return hstack(curves)
+
+
+# ==========================================================================
+#   Batch alignment of independent bones on a process pool
+#   Jobs and results are plain NumPy arrays so the workers never need bpy:
+#   curves are converted to float arrays before they are sent and only the
+#   path comes back (as int32), the aligned curves are indexed here
+# ==========================================================================
+
+
+def _align_job(job):
+    x, y, method, window, radius, dist = job
+    p, q = warp_path(x, y, method, window, radius, dist)
+    return p.astype(int32), q.astype(int32)
+
+
+def align_batch(pairs, method='dtw', window=None, radius=1, dist='l1',
+                workers=None):
+    """ Aligns many pairs of curves in parallel.
+
+    :param dict pairs: {bone: (curveA, curveB)}, curves are N*M sequences
+    :param int workers: number of processes, None uses every core and 1
+        runs in this process (e.g. inside Blender)
+
+    The other arguments are the same as warp_path(), a dist function has to
+    be picklable (no lambda). When using several workers call this from
+    under `if __name__ == "__main__":`.
+
+    Returns {bone: (alignedA, alignedB)} with frames*M float arrays.
+
+    """
+    bones = list(pairs)
+    curves = [(_as_frames(pairs[b][0]), _as_frames(pairs[b][1]))
+              for b in bones]
+    jobs = [(x, y, method, window, radius, dist) for x, y in curves]
+
+    if workers == 1:
+        paths = [_align_job(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            paths = list(pool.map(_align_job, jobs))
+
+    return dict((b, (x[p], y[q]))
+                for b, (x, y), (p, q) in zip(bones, curves, paths))
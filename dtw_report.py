@@ -0,0 +1,70 @@
+# ==========================================================================
+# Accuracy versus speed of fastdtw() against the exact dtw()
+# Every pair of recordings of the same hand in data/ is aligned on the
+# hand pitch, roll and yaw and the distance error and run time are printed
+# Usage: python dtw_report.py [radius ...]
+# ==========================================================================
+
+import os
+import sys
+import time
+from itertools import combinations
+
+import numpy as np
+
+from dtw import dtw, fastdtw
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+COLUMNS = ["Hand Pitch", "Hand Roll", "Hand Yaw"]
+
+
+# ==========================================================================
+#   Read the given columns of a Leap CSV recording into a frames*3 array
+# ==========================================================================
+def loadColumns(filename, columns=COLUMNS):
+    with open(filename) as f:
+        header = f.readline().strip().split(",")
+    usecols = [header.index(c) for c in columns]
+    return np.loadtxt(filename, delimiter=",", skiprows=1, usecols=usecols,
+                      ndmin=2)
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def report(radii):
+    takes = {}
+    for name in sorted(os.listdir(DATA)):
+        if name.endswith(".csv"):
+            hand = name.split("_")[0]
+            takes.setdefault(hand, []).append(name)
+
+    print("%-36s %7s %9s %8s %9s %8s %7s" % (
+        "pair", "radius", "distance", "error %", "time (s)", "speedup",
+        "cells %"))
+
+    for hand in sorted(takes):
+        for a, b in combinations(takes[hand], 2):
+            x = loadColumns(os.path.join(DATA, a))
+            y = loadColumns(os.path.join(DATA, b))
+            pair = "%s x %s (%dx%d)" % (a[:-4], b[:-4], len(x), len(y))
+
+            (exact, D, path), exactTime = timed(dtw, x, y)
+            print("%-36s %7s %9.2f %8.2f %9.3f %8s %7.1f" % (
+                pair, "exact", exact, 0.0, exactTime, "1.0x", 100.0))
+
+            for radius in radii:
+                (approx, D, path), fastTime = timed(fastdtw, x, y, radius)
+                error = 100.0 * (approx - exact) / exact if exact else 0.0
+                cells = 100.0 * np.isfinite(D).sum() / (len(x) * len(y))
+                print("%-36s %7d %9.2f %8.2f %9.3f %7.1fx %7.1f" % (
+                    "", radius, approx, error, fastTime,
+                    exactTime / fastTime, cells))
+
+
+if __name__ == "__main__":
+    radii = [int(r) for r in sys.argv[1:]] or [1, 5, 10, 30]
+    report(radii)
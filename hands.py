@@ -1,6 +1,11 @@
-import csv
+import os
+import sys
 from pyfbsdk import FBCreateObject, FBVector3d
 
+# leap_data.py lives next to this file
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from leap_data import read_chunks
+
 # get file
 # filename = input('Enter the filename')
 filename = "D:/Documents/courses/414/leap/data/left_dribble.csv"
@@ -27,12 +32,7 @@ class HandsMaker:
                                     "Wrist")
         self.skelNames = [" ".join([f, j, "End"])
                     for f in self.FINGERS for j in self.JOINTS]
-        time = 0
-
-    def joint_key(self, joint_name):
-        axes = list('XYZ')
-        return [" ".join([joint_name, axis]) for axis in axes]
-
+        self.time = 0
 
     def fileApply(self, lines_func):
         # create skeleton nodes based on objects
@@ -47,26 +47,19 @@ class HandsMaker:
             # get animation nodes
             self.skelAnimationNodes = [x.Translation.GetAnimationNode()
                                        for x in self.skel]
-        # read and apply lines_func to each line read
-        with open(filename, 'rb') as handfile:
-            reader = csv.DictReader(handfile)
-            map(lines_func, reader)
-            #lines_func(reader.next())
+        # read the recording in blocks, only the joint columns are parsed,
+        # and apply lines_func to the joint positions of each frame
+        for block in read_chunks(filename, self.skelNames):
+            positions = block.reshape(len(block), -1, 3)
+            for frame in positions.tolist():
+                lines_func(frame)
 
 
-    # get the position vector for a given joint in the current dict
-    def posVector(self, joint_name, line_dict):
-        return FBVector3d(*[float(line_dict[k]) for k in self.joint_key(joint_name)])
-
     # parse and work with each line
-    def processLine(self, line_dict):
-        # start creating skeleton root at the wrist?
-##        wrist_vector = self.posVector("Wrist", line_dict)
-##        self.wrist.Translation = wrist_vector
-##        self.wrist.Show = True
-
+    # "frame" holds the (X, Y, Z) position of every skelNames joint
+    def processLine(self, frame):
         # set vectors for each skeleton node
-        for node, vector in zip(self.skelAnimationNodes, [self.posVector(x, line_dict) for x in self.skelNames]):
+        for node, vector in zip(self.skelAnimationNodes, [FBVector3d(*x) for x in frame]):
             # add key to fcurves for each animation node (translation XYZ values)
             fcurves = [n.FCurve for n in node.Nodes]
             for fcurve, axis in zip(fcurves, vector):
@@ -0,0 +1,150 @@
+# ==========================================================================
+# Compact binary format for Leap captures, an alternative to the CSV text
+# written by leap_csv.cpp
+#
+# Layout (little-endian):
+#   8 bytes   magic "LEAPBIN1"
+#   4 bytes   uint32, length of the JSON header
+#   n bytes   JSON header: {"columns": [[name, dtype], ...]}
+#   records   one packed record per frame, fields in header order
+#
+# The frame count is whatever follows the header, so a capture can be
+# appended to while it is recorded. Ids and timestamps are stored as ints
+# and the measurements as float32, which keeps the 6 significant digits
+# leap_csv.cpp prints: converting a CSV file is lossless
+# Usage: python leap_binary.py data/*.csv
+# ==========================================================================
+
+import json
+import struct
+import sys
+
+import numpy as np
+
+from leap_data import COLUMNS, read_chunks
+
+MAGIC = b'LEAPBIN1'
+EXTENSION = '.leapbin'
+
+# Columns that hold ids and counts, every other column is a float32
+INT64 = ['Frame Id', 'Timestamp']
+INT32 = ['Hands', 'Extended Fingers', 'Tools', 'Gestures', 'Hand Id',
+         'Thumb Id', 'Index Id', 'Middle Id', 'Ring Id', 'Pinky Id']
+
+
+def _dtype(name):
+    if name in INT64:
+        return '<i8'
+    if name in INT32:
+        return '<i4'
+    return '<f4'
+
+
+# (name, dtype) of the leap_csv.cpp columns
+CSV_COLUMNS = [(name, _dtype(name)) for name in COLUMNS]
+
+
+def record_dtype(columns):
+    return np.dtype([(str(name), str(dtype)) for name, dtype in columns])
+
+
+def header(columns):
+    text = json.dumps({'columns': [list(c) for c in columns]})
+    text = text.encode('utf-8')
+    return MAGIC + struct.pack('<I', len(text)) + text
+
+
+# ==========================================================================
+#   Append frames to a binary capture
+#   "columns" is a list of (name, dtype), the CSV schema by default
+# ==========================================================================
+class BinaryWriter(object):
+
+    def __init__(self, filename, columns=CSV_COLUMNS):
+        self.dtype = record_dtype(columns)
+        self.file = open(filename, 'wb')
+        self.file.write(header(columns))
+        self.frames = 0
+
+    # rows = (frames, columns) array in column order
+    def write(self, rows):
+        rows = np.asarray(rows)
+        records = np.empty(len(rows), dtype=self.dtype)
+        for i, name in enumerate(self.dtype.names):
+            records[name] = rows[:, i]
+        self.file.write(records.tobytes())
+        self.frames += len(records)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# ==========================================================================
+#   A memory-mapped binary capture
+#   column() and vector() are zero-copy views into the file
+# ==========================================================================
+class BinaryCapture(object):
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s is not a Leap binary capture" % filename)
+            size, = struct.unpack('<I', f.read(4))
+            self.columns = [tuple(c) for c in
+                            json.loads(f.read(size).decode('utf-8'))['columns']]
+
+        self.dtype = record_dtype(self.columns)
+        self.offset = len(MAGIC) + 4 + size
+        self.buffer = np.memmap(filename, dtype=np.uint8, mode='r')
+        self.records = np.frombuffer(self.buffer, dtype=self.dtype,
+                                     offset=self.offset,
+                                     count=(len(self.buffer) - self.offset) //
+                                     self.dtype.itemsize)
+
+    def __len__(self):
+        return len(self.records)
+
+    # all the frames of one column, e.g. column('Hand Pitch')
+    def column(self, name):
+        return self.records[name]
+
+    # (frames, 3) view of the X, Y and Z columns of a vector,
+    # e.g. vector('Wrist Position')
+    def vector(self, name):
+        fields = [name + ' X', name + ' Y', name + ' Z']
+        dtype, offset = self.dtype.fields[fields[0]]
+        for k, field in enumerate(fields):
+            if self.dtype.fields[field] != (dtype, offset + k * dtype.itemsize):
+                raise ValueError("%s is not stored as 3 packed %s"
+                                 % (name, dtype))
+        return np.ndarray((len(self), 3), dtype=dtype, buffer=self.buffer,
+                          offset=self.offset + offset,
+                          strides=(self.dtype.itemsize, dtype.itemsize))
+
+    # (frames, columns) float64 copy, in the same layout as leap_data
+    def table(self):
+        return np.column_stack([self.records[name].astype(float)
+                                for name in self.dtype.names])
+
+
+# ==========================================================================
+#   Convert a CSV recording, block by block
+# ==========================================================================
+def convert(csv_filename, filename=None):
+    if filename is None:
+        filename = csv_filename.rsplit('.', 1)[0] + EXTENSION
+    with BinaryWriter(filename) as writer:
+        for block in read_chunks(csv_filename):
+            writer.write(block)
+    return filename
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:]:
+        print("%s -> %s" % (name, convert(name)))
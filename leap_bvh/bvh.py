@@ -6,49 +6,95 @@
 # 	Create the header section of a BVH file
 # 	joints = List containing joint names (strings)
 # 	offsets = List containing offsets (strings)
+# 	The joints are the LEAP hand layout: the root followed by one
+# 	Metacarpal to Distal chain per finger, see createHierarchy
 ###===================================================================
 def createHeader(joints, offsets):
-
-    header = "HIERARCHY"
-
-    # Strings used in header
-    root = " 6 Xposition Yposition Zposition Zrotation Yrotation Xrotation"
-    joint = " 3 Zrotation Yrotation Xrotation"
-
-    # Keep track of channels to add to BVH
-    channels = [root] + [joint] * (len(joints) - 1)
-
-    # Keep track of number of tabs (aesthetic formatting only)
-    counter = 0
+    parents = []
+    joint_offsets = []
+    end_sites = {}
 
     for c, joint in enumerate(joints):
-    	# Root node
+        # Root node
         if c == 0:
-            header += '\n' + '\t'*(c - counter) +  'ROOT %s\n{\n'%(joint) + '\t'*(c - counter + 1) + 'OFFSET %s \n'%(offsets[c]) + '\t'*(c - counter + 1) +'CHANNELS %s '%(channels[c])
-            continue
+            parents.append(-1)
+            joint_offsets.append(offsets[c])
+        # First joint (connected to the root, distance should be 0)
+        elif joint[-10:] == "Metacarpal":
+            parents.append(0)
+            joint_offsets.append("0.0 0.0 0.0")
+        # Any other joint starts where the previous bone ends
+        else:
+            parents.append(c - 1)
+            joint_offsets.append(offsets[c-1])
 
         # End Site (Distal bone)
         if joint[-6:] == "Distal":
-            header += '\n' + '\t'*(c - counter) +  'JOINT %s\n'%(joint) + '\t'*(c - counter) + '{\n' + '\t'*(c - counter + 1) + 'OFFSET %s \n'%(offsets[c-1]) + '\t'*(c - counter + 1) +'CHANNELS %s '%(channels[c])
-            header += '\n' + '\t' * (c - counter + 1) + 'End Site\n' + '\t' * (c - counter + 1) + '{\n' +'\t' * (c - counter + 2) + 'OFFSET %s\n'%(offsets[c])
-            temp = counter
-            counter = c
-            # Add closing braces
-            while (c - temp >= 0):
-                header += '\t'*(c - temp + 1) + '}\n'
-                c -= 1
+            end_sites[c] = offsets[c]
 
-        # First joint (connected to the root, distance should be 0)
-        elif joint[-10:] == "Metacarpal":
-            header += '\n' + '\t'*(c - counter) +  'JOINT %s\n'%(joint) + '\t'*(c - counter + 1) + '{\n' + '\t'*(c - counter + 1) + 'OFFSET 0.0 0.0 0.0\n' + '\t'*(c - counter + 1) +'CHANNELS %s '%(channels[c])
+    return createHierarchy(joints, parents, joint_offsets, end_sites)
+
+# Channels of the root and of every other joint
+ROOT_CHANNELS = "6 Xposition Yposition Zposition Zrotation Yrotation Xrotation"
+JOINT_CHANNELS = "3 Zrotation Yrotation Xrotation"
+
+###===================================================================
+# 	Create the header section of a BVH file for any skeleton
+# 	joints = List containing joint names (strings)
+# 	parents = Index of the parent of every joint, -1 for the root
+# 	offsets = Offset of every joint from its parent (strings or x, y, z)
+# 	end_sites = {joint index: offset} of the End Sites (leaf joints)
+# 	channels = Channels of every joint (default ROOT/JOINT_CHANNELS)
+# 	The tree is walked once with an explicit stack, so any number of
+# 	joints and any depth work in linear time
+###===================================================================
+def createHierarchy(joints, parents, offsets, end_sites=None, channels=None):
+    end_sites = end_sites or {}
+
+    children = [[] for _ in joints]
+    roots = []
+    for c, parent in enumerate(parents):
+        if parent < 0:
+            roots.append(c)
+        else:
+            children[parent].append(c)
+
+    def offset(value):
+        if isinstance(value, str):
+            return value.strip()
+        return " ".join(str(v) for v in value)
+
+    out = ["HIERARCHY\n"]
+
+    # (joint, depth) to open, or (None, depth) to close a brace
+    stack = [(c, 0) for c in reversed(roots)]
+    while stack:
+        c, depth = stack.pop()
+        tabs = '\t' * depth
+        if c is None:
+            out.append(tabs + "}\n")
+            continue
 
-        # Any other joint
+        if channels is not None:
+            joint_channels = channels[c]
         else:
-            header += '\n' + '\t'*(c - counter) +  'JOINT %s\n'%(joint) + '\t'*(c - counter + 1) + '{\n' + '\t'*(c - counter + 1) + 'OFFSET %s \n'%(offsets[c-1]) + '\t'*(c - counter + 1) +'CHANNELS %s '%(channels[c])
+            joint_channels = ROOT_CHANNELS if parents[c] < 0 else JOINT_CHANNELS
+
+        out.append("%s%s %s\n" % (tabs, "ROOT" if parents[c] < 0 else "JOINT",
+                                   joints[c]))
+        out.append(tabs + "{\n")
+        out.append("%s\tOFFSET %s\n" % (tabs, offset(offsets[c])))
+        out.append("%s\tCHANNELS %s\n" % (tabs, joint_channels))
 
-    header += "}\n"
+        if c in end_sites:
+            out.append("%s\tEnd Site\n%s\t{\n%s\t\tOFFSET %s\n%s\t}\n"
+                       % (tabs, tabs, tabs, offset(end_sites[c]), tabs))
 
-    return header
+        stack.append((None, depth))
+        for child in reversed(children[c]):
+            stack.append((child, depth + 1))
+
+    return "".join(out)
 
 ###===================================================================
 # 	Create the motion section of a BVH file
@@ -62,3 +108,45 @@ def createMotion(motions, time):
     motion += "\n".join(motions)
 
     return motion
+
+###===================================================================
+# 	Write a BVH file incrementally, one frame at a time
+# 	The frame count and frame time are only known at the end, so they are
+# 	written as fixed width placeholders and patched in place by close()
+# 	Memory stays flat and a crash only loses the frames not yet flushed
+# 	filename = path of the BVH file to write
+###===================================================================
+class BVHWriter(object):
+
+    # Width of the patched "Frames:" and "Frame Time:" values
+    FRAMES_WIDTH = 12
+    TIME_WIDTH = 24
+
+    def __init__(self, filename):
+        # Line buffered: every frame reaches the OS as soon as it is written
+        self.file = open(filename, 'w', 1)
+        self.frames = 0
+        self.motion_offset = None
+
+    # header = HIERARCHY section, see createHeader
+    def writeHeader(self, header):
+        self.file.write(header)
+        self.file.write("MOTION\n")
+        self.motion_offset = self.file.tell()
+        self.writeCounts(0, 0)
+
+    def writeCounts(self, frames, time):
+        self.file.write("Frames: %-*s\nFrame Time: %-*s\n" % (
+            self.FRAMES_WIDTH, frames, self.TIME_WIDTH, repr(float(time))))
+
+    # motion = all motions of a frame (string)
+    def writeFrame(self, motion):
+        self.file.write(motion + "\n")
+        self.frames += 1
+
+    # time = time frame value
+    def close(self, time):
+        if self.motion_offset is not None:
+            self.file.seek(self.motion_offset)
+            self.writeCounts(self.frames, time)
+        self.file.close()
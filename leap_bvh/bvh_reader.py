@@ -0,0 +1,165 @@
+###===================================================================
+# 	BVH reader, the counterpart of bvh.py
+# 	The HIERARCHY is parsed into a small joint table (names, parent
+# 	indices, offsets, channels) and the MOTION block is read straight into
+# 	a (frames, channels) float32 array, so BVH files can be re-processed
+# 	(DTW, scaling) without importing them into Blender
+# 	Usage: python bvh_reader.py file.bvh
+###===================================================================
+
+import mmap
+import sys
+
+import numpy as np
+
+
+###===================================================================
+# 	Parsed BVH file
+# 	names = joint names, in file order
+# 	parents = (J,) int32 index of every joint's parent, -1 for the root
+# 	offsets = (J, 3) float32 joint offsets
+# 	channels = channel names of every joint, e.g. ['Zrotation', ...]
+# 	first = (J,) int32 column of every joint's first channel in motion
+# 	end_sites = {joint index: (3,) float32 End Site offset}
+# 	frame_time = seconds per frame
+# 	motion = (frames, channels) float32 array
+###===================================================================
+class BVH(object):
+    def __init__(self, names, parents, offsets, channels, end_sites,
+                 frame_time, motion):
+        self.names = names
+        self.parents = np.asarray(parents, dtype=np.int32)
+        self.offsets = np.asarray(offsets, dtype=np.float32).reshape(-1, 3)
+        self.channels = channels
+        counts = [len(c) for c in channels]
+        self.first = np.cumsum([0] + counts[:-1]).astype(np.int32)
+        self.end_sites = end_sites
+        self.frame_time = frame_time
+        self.motion = motion
+        self.index = dict((name, c) for c, name in enumerate(names))
+
+    def __len__(self):
+        return len(self.motion)
+
+    def children(self, joint):
+        c = self.index[joint]
+        return [self.names[i] for i in np.nonzero(self.parents == c)[0]]
+
+    # All channels of a joint, (frames, n) view of motion
+    def joint(self, joint):
+        c = self.index[joint]
+        first = self.first[c]
+        return self.motion[:, first:first + len(self.channels[c])]
+
+    # One channel of a joint, e.g. channel('RightHand', 'Zrotation')
+    def channel(self, joint, name):
+        c = self.index[joint]
+        return self.motion[:, self.first[c] + self.channels[c].index(name)]
+
+
+###===================================================================
+# 	Parse the HIERARCHY section into the joint table
+# 	lines = header lines, from HIERARCHY up to MOTION
+# 	Joint names may contain spaces ("Thumb Metacarpal"), so the header is
+# 	read line by line; it is tiny next to the motion data
+###===================================================================
+def parseHierarchy(lines):
+    names, parents, offsets, channels = [], [], [], []
+    end_sites = {}
+    stack = []
+    in_end_site = False
+
+    for line in lines:
+        words = line.split()
+        if not words:
+            continue
+        key = words[0]
+
+        if key in ("ROOT", "JOINT"):
+            names.append(line.split(None, 1)[1].strip())
+            parents.append(stack[-1] if stack else -1)
+            offsets.append((0.0, 0.0, 0.0))
+            channels.append([])
+        elif key == "End":
+            in_end_site = True
+        elif key == "OFFSET":
+            offset = tuple(float(v) for v in words[1:4])
+            if in_end_site:
+                end_sites[stack[-1]] = np.array(offset, dtype=np.float32)
+            else:
+                offsets[-1] = offset
+        elif key == "CHANNELS":
+            channels[-1] = words[2:2 + int(words[1])]
+        elif key == "{":
+            if not in_end_site:
+                stack.append(len(names) - 1)
+        elif key == "}":
+            if in_end_site:
+                in_end_site = False
+            else:
+                stack.pop()
+
+    return names, parents, offsets, channels, end_sites
+
+
+###===================================================================
+# 	Read a BVH file
+# 	The file is memory-mapped to find the MOTION block, and the numbers
+# 	are parsed in bulk by NumPy from there. A ValueError is raised when
+# 	the values don't make whole frames of the HIERARCHY's channels or
+# 	their number of frames isn't the "Frames:" count, except for the
+# 	placeholder counts of a BVHWriter that was never closed
+###===================================================================
+def read(filename):
+    with open(filename, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            motion_start = mm.find(b"MOTION")
+            if motion_start < 0:
+                raise ValueError("%s: no MOTION section" % filename)
+            header = mm[:motion_start].decode("ascii").splitlines()
+
+            time_start = mm.find(b"Frame Time:", motion_start)
+            if time_start < 0:
+                raise ValueError("%s: no Frame Time" % filename)
+            frames_start = mm.find(b"Frames:", motion_start, time_start)
+            if frames_start < 0:
+                raise ValueError("%s: no Frames" % filename)
+            declared = int(mm[frames_start + len(b"Frames:"):time_start])
+            time_end = mm.find(b"\n", time_start)
+            if time_end < 0:
+                time_end = len(mm)
+            frame_time = float(mm[time_start + len(b"Frame Time:"):time_end])
+        finally:
+            mm.close()
+
+        names, parents, offsets, channels, end_sites = parseHierarchy(header)
+        width = sum(len(c) for c in channels)
+
+        f.seek(time_end)
+        values = np.fromfile(f, dtype=np.float32, sep=" ")
+
+    if width == 0:
+        raise ValueError("%s: no channels" % filename)
+    if len(values) % width != 0:
+        raise ValueError("%s: %d values don't make frames of %d channels"
+                         % (filename, len(values), width))
+    frames = len(values) // width
+
+    # BVHWriter writes 0 frames and a 0 frame time until it is closed
+    placeholder = declared == 0 and frame_time == 0
+    if frames != declared and not placeholder:
+        raise ValueError("%s: %d frames, the header says %d"
+                         % (filename, frames, declared))
+    motion = values.reshape(frames, width)
+
+    return BVH(names, parents, offsets, channels, end_sites, frame_time,
+               motion)
+
+
+if __name__ == "__main__":
+    for filename in sys.argv[1:]:
+        bvh = read(filename)
+        print("%s: %d joints, %d frames x %d channels, %g s/frame" % (
+            filename, len(bvh.names), len(bvh), bvh.motion.shape[1],
+            bvh.frame_time))
@@ -0,0 +1,55 @@
+###===================================================================
+# 	Vectorized Euler angles for LEAP bone rotations
+# 	Same convention as BVHListener.rotation_to_euler, but for any number of
+# 	rotation matrices at once so a whole recorded session can be converted
+# 	in a single array operation. Only depends on NumPy (no Leap SDK)
+###===================================================================
+
+import numpy as np
+
+
+###===================================================================
+# 	Turn flat LEAP bases into rotation matrices
+# 	bases = (..., 9) array as returned by Matrix.to_array_3x3()
+# 	inverse = return the rigid inverse (transpose) of every basis, like
+# 	bone.basis.rigid_inverse().to_array_3x3() in leap_reader.py
+###===================================================================
+def bases_to_matrices(bases, inverse=True):
+    R = np.asarray(bases, dtype=float).reshape(-1, 3, 3)
+    if inverse:
+        R = R.transpose(0, 2, 1)
+    return R
+
+
+###===================================================================
+# 	Convert rotation matrices to Euler angles (degrees)
+# 	R = (N, 3, 3) array of rotation matrices
+# 	flip_x = negate the first column of every matrix, used for left hands
+# 	Returns a (N, 3) array in BVH channel order (Z, Y, X rotation)
+#
+# 	Algorithm from http://staff.city.ac.uk/~sbbh653/publications/euler.pdf
+# 	Matrices in gimbal lock (R[2, 0] == +-1) are handled with a mask
+###===================================================================
+def rotations_to_euler(R, flip_x=False):
+    R = np.array(R, dtype=float).reshape(-1, 3, 3)
+    if flip_x is not False:
+        # flip_x may also be a (N,) mask of the matrices to flip
+        flip = np.broadcast_to(flip_x, R.shape[:1])
+        R[flip, :, 0] *= -1
+
+    r20 = R[:, 2, 0]
+    lock = (r20 == 1) | (r20 == -1)
+
+    roll = -np.arcsin(np.clip(r20, -1, 1))
+    cos_roll = np.cos(roll)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        yaw = np.arctan2(R[:, 2, 1] / cos_roll, R[:, 2, 2] / cos_roll)
+        pitch = np.arctan2(R[:, 1, 0] / cos_roll, R[:, 0, 0] / cos_roll)
+
+    # Gimbal lock: pitch is set to 0 and the rotation is put in the yaw
+    alpha = np.arctan2(R[:, 0, 1], R[:, 0, 2])
+    pitch = np.where(lock, 0, pitch)
+    roll = np.where(lock, np.where(r20 == -1, np.pi / 2, -np.pi / 2), roll)
+    yaw = np.where(lock, alpha, yaw)
+
+    return np.degrees(np.stack([pitch, roll, yaw], axis=1))
@@ -7,88 +7,167 @@
 ##########################################################################
 
 from __future__ import print_function
+import argparse
+import json
 import sys
+import threading
 import numpy as np
-from bvh import createHeader, createMotion
-
-from numpy.linalg import inv
-from numpy import float64, hypot, zeros, matrix
+from bvh import createHeader, createMotion, BVHWriter
+from euler import bases_to_matrices, rotations_to_euler
 
 # if you don't have the LeapSDK setup in PATH, use:
 # sys.path.insert(0, "/Users/aaron_t15/Desktop/LeapSDK/lib")
 
 import Leap
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class CaptureRing(object):
+    """ Preallocated ring of raw frames handed from the Leap callback to a
+        worker thread. The callback only takes a free slot, copies floats
+        into it and publishes it; the worker converts and recycles it """
+
+    def __init__(self, capacity, bones=20):
+        self.bases = np.zeros((capacity, bones, 9))
+        self.skip = np.zeros((capacity, bones), dtype=bool)
+        self.hands = np.zeros((capacity, 3))
+        self.fps = np.zeros(capacity)
+        self.is_left = np.zeros(capacity, dtype=bool)
+
+        self.free = queue.Queue()
+        self.ready = queue.Queue()
+        for slot in range(capacity):
+            self.free.put(slot)
+
+        # Counters used to size the ring for high fps capture
+        self.captured = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    """ Frames waiting for the worker """
+    def depth(self):
+        return self.ready.qsize()
+
+    """ Next free slot, None (and a dropped frame) when the ring is full """
+    def acquire(self):
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return None
+
+    def publish(self, slot):
+        self.ready.put(slot)
+        self.captured += 1
+        self.max_depth = max(self.max_depth, self.ready.qsize())
+
+    def release(self, slot):
+        self.free.put(slot)
+
 
 class BVHListener(Leap.Listener):
     """ A LEAP listener that writes BVH """
     finger_names = ['Thumb', 'Index', 'Middle', 'Ring', 'Pinky']
     bone_names = ['Metacarpal', 'Proximal', 'Intermediate', 'Distal']
 
-    def __init__(self):
+    def __init__(self, filename=None, threaded=False, capacity=1024,
+                 calibration=None):
         Leap.Listener.__init__(self)
         self.first_frame = 0
         self.frame_times = 0
         self.channel_data = []
 
+        # Bone lengths of the subject measured over whole takes (see
+        # calibration.py), the first frame then only gives the directions
+        self.calibration = {}
+        if calibration:
+            with open(calibration) as f:
+                self.calibration = json.load(f)["hands"]
+
+        # With a filename the BVH is streamed to disk frame by frame
+        # instead of being printed once the capture ends
+        self.writer = BVHWriter(filename) if filename else None
+
+        # Threaded capture: on_frame only copies the raw bone bases into
+        # the ring, the Euler conversion and formatting run in a worker
+        self.ring = None
+        if threaded:
+            self.ring = CaptureRing(capacity)
+            self.worker = threading.Thread(target=self.convert_frames)
+            self.worker.daemon = True
+            self.worker.start()
+
     def on_exit(self, controller):
+        if self.ring:
+            # Let the worker drain the ring before writing the motion
+            self.ring.ready.put(None)
+            self.worker.join()
+            print("Captured %d frames, dropped %d, max queue depth %d"
+                  % (self.ring.captured, self.ring.dropped,
+                     self.ring.max_depth), file=sys.stderr)
+
+        frames = self.writer.frames if self.writer else len(self.channel_data)
+
         # Calculate avg fps from # of frames and total fps
-        frame_sample = 1 / (self.frame_times / len(self.channel_data))
+        frame_sample = 1 / (self.frame_times / frames) if frames else 0
+
+        if self.writer:
+            self.writer.close(frame_sample)
+        else:
+            print(createMotion(self.channel_data, frame_sample))
+
+    """ Output the HIERARCHY section """
+    def write_header(self, header):
+        if self.writer:
+            self.writer.writeHeader(header)
+        else:
+            print(header)
 
-        print(createMotion(self.channel_data, frame_sample))
+    """ Output the motion of one frame """
+    def write_frame(self, frame_data):
+        if self.writer:
+            self.writer.writeFrame(frame_data)
+        else:
+            self.channel_data.append(frame_data)
 
     """ Convert a leap Vector class to a string """
     def vec_to_str(self, v):
         return " ".join(str(i) for i in [v.x, v.y, v.z])
 
-    """ NumPy-ify a LEAP matrix's 3x3 array """
-    def npmat(self, mat):
-        return np.matrix([[mat[0], mat[1], mat[2]],
-                          [mat[3], mat[4], mat[5]],
-                          [mat[6], mat[7], mat[8]]])
-
     """ Get Euler angles as calculated in the LEAP API sample code """
-    def hand_to_euler(self, normal, direction):
+    def hand_angles(self, normal, direction):
         pitch = direction.pitch * Leap.RAD_TO_DEG
         yaw = direction.yaw * Leap.RAD_TO_DEG
         roll = normal.roll * Leap.RAD_TO_DEG
-        return "%s %s %s " % (roll, pitch, yaw)
+        return roll, pitch, yaw
+
+    def hand_to_euler(self, normal, direction):
+        return "%s %s %s " % self.hand_angles(normal, direction)
 
     """ Convert 3x3 rotation matrix to euler angles """
     def rotation_to_euler(self, R):
-        # old decomposition
-        # yaw = np.arctan2(R[2,1], R[2,2])
-        # roll = np.arctan2(-R[2,0], np.sqrt(R[2,1]*R[2,1] + R[2,2]*R[2,2]))
-        # pitch = np.arctan2(R[1,0], R[0,0])
-
         # Algorithem from
         # http://staff.city.ac.uk/~sbbh653/publications/euler.pdf
-        # xxxx1 and xxxx2 are oppsoites rotations of each other
-
-        if R[2, 0] != 1 and R[2, 0] != -1:
-            roll1 = -np.arcsin(R[2, 0])
-            roll2 = np.pi - roll1
-
-            yaw1 = np.arctan2(R[2, 1]/np.cos(roll1), R[2, 2]/np.cos(roll1))
-            yaw2 = np.arctan2(R[2, 1]/np.cos(roll2), R[2, 2]/np.cos(roll2))
-
-            pitch1 = np.arctan2(R[1, 0]/np.cos(roll1), R[0, 0]/np.cos(roll1))
-            pitch2 = np.arctan2(R[1, 0]/np.cos(roll2), R[0, 0]/np.cos(roll2))
-
-        else:
-            pitch1 = pitch2 = 0
-            alpha = np.arctan2(R[0, 1], R[0, 2])
-
-            if R[2, 0] == -1:
-                roll1 = roll2 = np.pi/2
-                yaw1 = yaw2 = pitch1 + alpha
+        # see euler.py, which converts many matrices at once
+        return "%s %s %s " % tuple(rotations_to_euler(R)[0])
+
+    """ Euler angles of all the bones of a hand in one vectorized pass
+        bases = (bones, 9) raw bone bases, skip = bones written as 0 0 0 """
+    def bones_to_euler(self, bases, skip, is_left):
+        # The rigid inverse of an orthonormal basis is its transpose
+        angles = rotations_to_euler(bases_to_matrices(bases), flip_x=is_left)
+
+        bone_data = ""
+        for k in range(len(angles)):
+            if skip[k]:
+                bone_data += "0 0 0 "
             else:
-                roll1 = roll2 = -np.pi/2
-                yaw1 = yaw2 = -pitch1 + alpha
-
-        return "%s %s %s " % (pitch1 * Leap.RAD_TO_DEG,
-                              roll1 * Leap.RAD_TO_DEG,
-                              yaw1 * Leap.RAD_TO_DEG)
+                bone_data += "%s %s %s " % tuple(angles[k])
+        return bone_data
 
     def on_frame(self, controller):
         frame = controller.frame()
@@ -106,43 +185,103 @@ class BVHListener(Leap.Listener):
                 joints.insert(0, ("Right" if hand.is_right else "Left") + "Hand")
                 vector_offsets = [bone.next_joint - bone.prev_joint
                                   for bone in bones]
+                side = "left" if hand.is_left else "right"
+                if side in self.calibration:
+                    lengths = self.calibration[side]["lengths"]
+                    vector_offsets = [v.normalized * length for v, length
+                                      in zip(vector_offsets, lengths)]
                 vector_offsets.insert(0, Leap.Vector(0, 0, 0))
                 offsets = [self.vec_to_str(v) for v in vector_offsets]
-                print(createHeader(joints, offsets))
+                self.write_header(createHeader(joints, offsets))
                 self.first_frame = frame.id
 
+            if self.ring:
+                self.capture_frame(hand, frame)
+                continue
+
             # No need to capture hand location
             # Set to origin everytime
             frame_data = "0 0 0 "
             frame_data += self.hand_to_euler(hand.palm_normal, hand.direction)
 
             # Iterate through fingers
+            bases = np.zeros((20, 9))
+            skip = np.zeros(20, dtype=bool)
+            k = 0
             for finger in hand.fingers:
 
                 for b in range(4):
-                    bone = finger.bone(b)
-
                     # Thumb's have no Metacarpal bone
                     # but LEAP still returns a bone with length 0
                     # which throws off Blender
                     if finger.type() == Leap.Finger.TYPE_THUMB and b == 0:
-                        frame_data += "0 0 0 "
+                        skip[k] = True
                     else:
-                        #
-                        mat = self.npmat(bone.basis.rigid_inverse().to_array_3x3())
+                        bases[k] = finger.bone(b).basis.to_array_3x3()
+                    k += 1
 
-                        if hand.is_left:
-                            mat[:, 0] *= -1
+            frame_data += self.bones_to_euler(bases, skip, hand.is_left)
 
-                        frame_data += self.rotation_to_euler(mat)
-
-            self.channel_data.append(frame_data)
+            self.write_frame(frame_data)
             self.frame_times += frame.current_frames_per_second
 
+    """ Copy the raw data of a hand into the ring (Leap callback thread) """
+    def capture_frame(self, hand, frame):
+        ring = self.ring
+        slot = ring.acquire()
+        if slot is None:
+            return
+
+        ring.hands[slot] = self.hand_angles(hand.palm_normal, hand.direction)
+        ring.fps[slot] = frame.current_frames_per_second
+        ring.is_left[slot] = hand.is_left
+
+        k = 0
+        for finger in hand.fingers:
+            thumb = finger.type() == Leap.Finger.TYPE_THUMB
+            for b in range(4):
+                # Thumb's have no Metacarpal bone, see on_frame
+                ring.skip[slot, k] = thumb and b == 0
+                if not ring.skip[slot, k]:
+                    ring.bases[slot, k] = finger.bone(b).basis.to_array_3x3()
+                k += 1
+
+        ring.publish(slot)
+
+    """ Worker thread: convert the frames published in the ring """
+    def convert_frames(self):
+        ring = self.ring
+        while True:
+            slot = ring.ready.get()
+            if slot is None:
+                break
+
+            frame_data = "0 0 0 " + "%s %s %s " % tuple(ring.hands[slot])
+            frame_data += self.bones_to_euler(ring.bases[slot],
+                                              ring.skip[slot],
+                                              ring.is_left[slot])
+
+            self.frame_times += ring.fps[slot]
+            ring.release(slot)
+            self.write_frame(frame_data)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Record LEAP hands as BVH")
+    parser.add_argument("output", nargs="?",
+                        help="BVH file to stream to (default: stdout)")
+    parser.add_argument("--threaded", action="store_true",
+                        help="convert the frames in a worker thread off "
+                             "the callback")
+    parser.add_argument("-c", "--calibration",
+                        help="calibration file of the subject (see "
+                             "calibration.py) for the bone lengths")
+    args = parser.parse_args(argv)
 
-def main():
     # Create a sample listener and controller
-    listener = BVHListener()
+    listener = BVHListener(args.output, threaded=args.threaded,
+                           calibration=args.calibration)
     controller = Leap.Controller()
 
     controller.set_policy(Leap.Controller.POLICY_BACKGROUND_FRAMES)
@@ -0,0 +1,173 @@
+# ==========================================================================
+# Columnar NumPy loader for the CSV files written by leap_csv.cpp
+# The schema is fixed (one hand per row, 217 columns), so every column has
+# a known index and a whole recording is parsed into one array at once
+# The parsed table is cached next to the CSV as a .npy sidecar which later
+# loads are memory-mapped from instead of parsing the text again
+# ==========================================================================
+
+import os
+from itertools import islice
+
+import numpy as np
+
+FINGERS = ['Thumb', 'Index', 'Middle', 'Ring', 'Pinky']
+# leap_csv.cpp calls the intermediate bone "Middle"
+BONES = ['Metacarpal', 'Proximal', 'Middle', 'Distal']
+ENDS = ['Start', 'End', 'Direction']
+AXES = ['X', 'Y', 'Z']
+
+# Frame columns, in the order leap_csv.cpp writes them (the CSV header has
+# "Hands" and "Timestamp" swapped)
+FRAME = ['Frame Id', 'Timestamp', 'Hands', 'Extended Fingers', 'Tools',
+         'Gestures']
+# Vectors of the hand, written as X Y Z columns
+HAND_VECTORS = ['Hand Palm']
+ARM_VECTORS = ['Arm Direction', 'Wrist Position', 'Elbow Position']
+# Vectors of every finger bone, e.g. "Index Proximal End"
+BONE_VECTORS = [" ".join([f, b, e]) for f in FINGERS for b in BONES
+                for e in ENDS]
+VECTORS = HAND_VECTORS + ARM_VECTORS + BONE_VECTORS
+
+
+def _columns():
+    columns = list(FRAME)
+    columns += ['Hand Id']
+    columns += [" ".join([v, a]) for v in HAND_VECTORS for a in AXES]
+    columns += ['Hand Pitch', 'Hand Roll', 'Hand Yaw']
+    columns += [" ".join([v, a]) for v in ARM_VECTORS for a in AXES]
+    for f in FINGERS:
+        columns += [f + ' Id', f + ' Length', f + ' Width']
+        columns += [" ".join([f, b, e, a])
+                    for b in BONES for e in ENDS for a in AXES]
+    return columns
+
+
+# Column names and their index in a row
+COLUMNS = _columns()
+INDEX = dict((name, i) for i, name in enumerate(COLUMNS))
+WIDTH = len(COLUMNS)
+
+# Index of the X column of every vector, Y and Z follow it
+VECTOR_INDEX = dict((v, INDEX[v + ' X']) for v in VECTORS)
+
+
+class LeapCSV(object):
+    """ A Leap recording as a (frames, columns) float64 table. """
+
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return len(self.table)
+
+    # all the frames of one column, e.g. column('Hand Pitch')
+    def column(self, name):
+        return self.table[:, INDEX[name]]
+
+    # (frames, 3) array of a vector, e.g. vector('Wrist Position')
+    def vector(self, name):
+        i = VECTOR_INDEX[name]
+        return self.table[:, i:i + 3]
+
+    # (frames, len(names), 3) float32 array of several vectors,
+    # every vector when names is None
+    def vectors(self, names=None):
+        if names is None:
+            names = VECTORS
+        cols = np.array([VECTOR_INDEX[v] for v in names])
+        cols = cols[:, None] + np.arange(3)
+        return self.table[:, cols].astype(np.float32)
+
+
+# ==========================================================================
+#   Parse the text of a CSV recording
+#   Lines that aren't frames (header, gesture lines) are skipped and the
+#   columns after the hand (tools) are ignored
+# ==========================================================================
+def parse(filename):
+    with open(filename) as f:
+        lines = [line for line in f if line[:1].isdigit()]
+    if not lines:
+        return np.zeros((0, WIDTH))
+    return np.loadtxt(lines, delimiter=',', usecols=range(WIDTH), ndmin=2)
+
+
+# ==========================================================================
+#   Column indices of a list of names
+#   A name is either a column ("Hand Pitch") or a vector ("Wrist Position")
+#   which stands for its X, Y and Z columns
+# ==========================================================================
+def column_indices(names):
+    cols = []
+    for name in names:
+        if name in INDEX:
+            cols.append(INDEX[name])
+        elif name in VECTOR_INDEX:
+            cols.extend(range(VECTOR_INDEX[name], VECTOR_INDEX[name] + 3))
+        else:
+            raise KeyError("Unknown Leap CSV column %r" % (name))
+    return cols
+
+
+# ==========================================================================
+#   Read a CSV recording in blocks of at most "size" frames
+#   Only "names" (see column_indices) are converted, every column when None
+#   Memory is bounded by the block size, whatever the length of the file
+#   Yields (frames, columns) float64 arrays
+# ==========================================================================
+def read_chunks(filename, names=None, size=4096):
+    cols = range(WIDTH) if names is None else column_indices(names)
+    with open(filename) as f:
+        frames = (line for line in f if line[:1].isdigit())
+        while True:
+            lines = list(islice(frames, size))
+            if not lines:
+                break
+            yield np.loadtxt(lines, delimiter=',', usecols=cols, ndmin=2)
+
+
+# ==========================================================================
+#   "left" or "right", guessed from the file name (e.g. data/left_move.csv)
+# ==========================================================================
+def handedness(filename):
+    name = os.path.basename(filename).lower()
+    if name.startswith("left"):
+        return "left"
+    if name.startswith("right"):
+        return "right"
+    raise ValueError("Can't tell the hand of %s, use --hand" % filename)
+
+
+def sidecar(filename):
+    return filename + '.npy'
+
+
+# ==========================================================================
+#   Load a CSV recording, using the .npy sidecar when it is up to date
+#   "cache" = False always parses the CSV and doesn't write a sidecar
+#   The sidecar is memory-mapped read only
+# ==========================================================================
+def load(filename, cache=True):
+    cached = sidecar(filename)
+    if cache and os.path.exists(cached) and \
+            os.path.getmtime(cached) >= os.path.getmtime(filename):
+        table = np.load(cached, mmap_mode='r')
+        if table.ndim == 2 and table.shape[1] == WIDTH:
+            return LeapCSV(table)
+
+    table = parse(filename)
+    if cache:
+        # Kept as float64: float32 only has 24 bits of mantissa, the
+        # microsecond Timestamps (about 7e8 in data/) would move by up to
+        # 32us and ids past 2**24 wouldn't round trip
+        try:
+            # Write next to it first so a reader never sees half a file
+            with open(cached + '.tmp', 'wb') as f:
+                np.save(f, table)
+            if os.path.exists(cached):
+                os.remove(cached)
+            os.rename(cached + '.tmp', cached)
+        except (IOError, OSError):
+            pass
+    return LeapCSV(table)
@@ -0,0 +1,214 @@
+# ==========================================================================
+# Bone lengths and hand scale factors without Blender
+# The measurements of scaling.py's Scaler (middle finger chain of the leap
+# hand, hand and forearm of the body model, golden ratio when the model has
+# no hand) computed from joint tables: parsed BVH files (bvh_reader) or the
+# Start/End columns of leap_csv recordings, where the 20 finger bone lengths
+# of every frame come out of one array operation
+# Usage: python proportions.py [--curve] body.bvh hand.bvh|hand.csv [...]
+#   prints the factor Scaler would scale every hand by, --curve writes the
+#   time and scale of every frame to hand.scale for scale.py
+# ==========================================================================
+
+import os
+import re
+import sys
+
+import numpy as np
+
+from leap_data import FINGERS, BONES, INDEX, VECTOR_INDEX, LeapCSV, load
+from retarget import fromBVH, read
+
+# according to hypertextbook.com/facts/2006/bodyproportions.shtml
+# forarm+hand vs forarm ratio
+GOLDEN_RATIO = 1.618
+
+# name of the forarm bone of the model
+FOREARM = 'forearm'
+
+# Hand and middle finger of the model (cmu naming, see scaling.py)
+MODEL_HAND = 'lHand'
+MODEL_MIDDLE = 'lMid1'
+
+# The 20 finger bones, in leap_data order ("Thumb Metacarpal", ...)
+FINGER_BONES = [" ".join([f, b]) for f in FINGERS for b in BONES]
+# Columns of the middle finger chain (Metacarpal to Distal)
+MIDDLE = [FINGER_BONES.index("Middle " + b) for b in BONES]
+
+# leap_reader.py calls the "Middle" bone "Intermediate"
+BVH_NAMES = dict((" ".join([f, b]), " ".join([f, bvh])) for f in FINGERS
+                 for b, bvh in zip(BONES, ['Metacarpal', 'Proximal',
+                                           'Intermediate', 'Distal']))
+
+
+def _columns(names):
+    cols = np.array([VECTOR_INDEX[n] for n in names])
+    return cols[:, None] + np.arange(3)
+
+
+# ==========================================================================
+#   Length of the 20 finger bones in every frame of a leap_csv recording
+#   "csv" is a LeapCSV or its (frames, columns) table
+#   Returns a (frames, 20) array, columns in FINGER_BONES order
+# ==========================================================================
+def csvBoneLengths(csv):
+    table = csv.table if isinstance(csv, LeapCSV) else np.asarray(csv)
+    start = table[:, _columns([b + " Start" for b in FINGER_BONES])]
+    end = table[:, _columns([b + " End" for b in FINGER_BONES])]
+    return np.sqrt(((end - start) ** 2).sum(axis=2))
+
+
+# ==========================================================================
+#   Length of every joint of a parsed BVH, like the bones Blender imports
+#   (head to the End Site or to the mean head of the children)
+#   Returns {joint name: length}
+# ==========================================================================
+def bvhJointLengths(bvh):
+    skeleton = fromBVH(bvh)[0]
+    lengths = np.sqrt(((skeleton.tails - skeleton.heads) ** 2).sum(axis=1))
+    return dict(zip(skeleton.names, lengths.tolist()))
+
+
+# ==========================================================================
+#   Length of the 20 finger bones of a leap hand BVH (bvh.py layout)
+#   A bone's length is the offset of the next joint, the End Site for the
+#   Distal bone. Returns a (1, 20) array, like one frame of csvBoneLengths
+# ==========================================================================
+def bvhBoneLengths(bvh):
+    lengths = np.zeros((1, len(FINGER_BONES)))
+    for i, bone in enumerate(FINGER_BONES):
+        c = bvh.index[BVH_NAMES[bone]]
+        if c in bvh.end_sites:
+            offset = bvh.end_sites[c]
+        else:
+            offset = bvh.offsets[np.nonzero(bvh.parents == c)[0][0]]
+        lengths[0, i] = np.sqrt((np.asarray(offset, float) ** 2).sum())
+    return lengths
+
+
+# ==========================================================================
+#   Middle finger chain (Metacarpal to Distal) of (frames, 20) lengths,
+#   the hand length of Scaler.getLeapHandLength for every frame
+# ==========================================================================
+def leapHandLength(lengths):
+    return np.asarray(lengths)[..., MIDDLE].sum(axis=-1)
+
+
+# ==========================================================================
+#   Forearm and hand length of a body model, see Scaler.getForeArmLength
+#   and Scaler.getModelHandLength. -1 when the model has none
+#   "lengths" is {joint name: length}, see bvhJointLengths
+# ==========================================================================
+def foreArmLength(lengths, names=None, forearm=FOREARM):
+    pattern = re.compile(forearm, re.IGNORECASE)
+    for name in names or list(lengths):
+        if pattern.search(name):
+            return lengths[name]
+    return -1
+
+
+def modelHandLength(lengths, children, hand=MODEL_HAND, middle=MODEL_MIDDLE):
+    if middle not in lengths:
+        return -1
+    return lengths[hand] + lengths[middle] + \
+        sum(lengths[child] for child in children)
+
+
+# ==========================================================================
+#   Scale factor of the leap hand, see Scaler.getScaleFactor
+#   Works on arrays of leap hand lengths (e.g. every frame) as well
+# ==========================================================================
+def scaleFactor(leapHandLength, foreArmLength, modelHandLength=-1,
+                goldenRatio=GOLDEN_RATIO):
+    if foreArmLength <= 0:
+        return np.zeros_like(np.asarray(leapHandLength, dtype=float))
+    if modelHandLength < 0:
+        # in case where there isnt a hand available
+        # we scale it based on the golden ratio
+        modelHandLength = goldenRatio * foreArmLength - foreArmLength
+    return np.fabs(np.asarray(leapHandLength, dtype=float) / modelHandLength)
+
+
+# ==========================================================================
+#   Forearm and hand length of a body BVH file
+# ==========================================================================
+def modelMeasurements(bvh):
+    lengths = bvhJointLengths(bvh)
+    children = []
+    if MODEL_MIDDLE in bvh.index:
+        stack = [bvh.index[MODEL_MIDDLE]]
+        while stack:
+            c = stack.pop()
+            below = np.nonzero(bvh.parents == c)[0].tolist()
+            children.extend(bvh.names[i] for i in below)
+            stack.extend(below)
+    return (foreArmLength(lengths, bvh.names),
+            modelHandLength(lengths, children))
+
+
+# ==========================================================================
+#   Finger bone lengths of a hand take, (frames, 20) for CSV recordings and
+#   (1, 20) for BVH files
+# ==========================================================================
+def handBoneLengths(filename):
+    if filename.lower().endswith(".csv"):
+        return csvBoneLengths(load(filename))
+    return bvhBoneLengths(read(filename))
+
+
+# ==========================================================================
+#   Finger bone lengths of a hand take and the time of every frame in
+#   seconds from the first one (Timestamp column of CSV recordings, a
+#   single frame at 0 for BVH files)
+# ==========================================================================
+def handTake(filename):
+    if filename.lower().endswith(".csv"):
+        csv = load(filename)
+        stamps = csv.column('Timestamp')
+        # Timestamps are in microseconds
+        return csvBoneLengths(csv), (stamps - stamps[0]) / 1e6
+    return bvhBoneLengths(read(filename)), np.zeros(1)
+
+
+# ==========================================================================
+#   Scale of the hand at every frame of a take (1 / scale factor, what
+#   Scaler resizes the hand by) for scale.py's SCALE_FILE, one "time scale"
+#   line per frame. The times let scale.py resample the curve to its own
+#   keys, whatever the frame rate of the take. Returns the name of the
+#   written file
+#   A zero scale would collapse the hand, so a body without a forearm is a
+#   ValueError and frames without a hand length get the median scale
+# ==========================================================================
+def writeScaleCurve(filename, foreArm, modelHand, output=None):
+    if foreArm <= 0:
+        raise ValueError("The body has no %r bone to scale the hands to"
+                         % (FOREARM))
+    lengths, times = handTake(filename)
+    factors = scaleFactor(leapHandLength(lengths), foreArm, modelHand)
+    valid = factors > 0
+    if not valid.any():
+        raise ValueError("%s has no frame with a hand length" % filename)
+    scales = np.empty_like(factors)
+    scales[valid] = 1 / factors[valid]
+    scales[~valid] = np.median(scales[valid])
+
+    if output is None:
+        output = os.path.splitext(filename)[0] + ".scale"
+    np.savetxt(output, np.column_stack([times, scales]), fmt=["%.6f", "%g"])
+    return output
+
+
+if __name__ == "__main__":
+    # --curve writes the per-frame scale of every hand take next to it
+    args = sys.argv[1:]
+    curve = "--curve" in args
+    files = [a for a in args if not a.startswith("--")]
+
+    foreArm, modelHand = modelMeasurements(read(files[0]))
+    for filename in files[1:]:
+        if curve:
+            print(writeScaleCurve(filename, foreArm, modelHand))
+            continue
+        # The first frame is the rest pose of the BVH (see csv2bvh.py)
+        hand = leapHandLength(handBoneLengths(filename)[0])
+        print("%s: %g" % (filename, scaleFactor(hand, foreArm, modelHand)))
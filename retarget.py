@@ -0,0 +1,418 @@
+# ==========================================================================
+# Attaching hand takes to a body take without Blender
+# Same operations as the __main__ of attachment.py (join the armatures,
+# parent the hands to the body's hand bones, delete the body's own fingers,
+# reconnect the hand bones keeping their length and copy the hand rotations
+# into the body's action) on a NumPy skeleton and action, so takes can be
+# merged in batch on machines without Blender. attachment.py runs the
+# skeleton part on the edit bones through readSkeleton/writeSkeleton
+# Usage: python retarget.py [-j JOBS] [-o OUTDIR] body left right [...]
+#   the takes are BVH files, or CSV recordings of leap_csv for the hands
+# ==========================================================================
+
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "leap_bvh"))
+from bvh import createHeader, createHierarchy, JOINT_CHANNELS
+from bvh_reader import BVH, parseHierarchy, read
+
+# Hand bones of the body BVH (cmu naming, see attachment.py) and root bones
+# of the hand BVHs written by leap_reader.py
+BODY_HANDS = ("lHand", "rHand")
+HANDS = ("LeftHand", "RightHand")
+
+ROTATIONS = ("Xrotation", "Yrotation", "Zrotation")
+
+
+# ==========================================================================
+#   Rest pose of an armature, like Blender's edit bones
+#   names = bone names, parents = index of the parent of every bone (-1 for
+#   roots), heads and tails = (bones, 3) positions in armature space
+#   connected = use_connect of every bone
+# ==========================================================================
+class Skeleton(object):
+
+    def __init__(self, names, parents, heads, tails, connected=None):
+        self.names = list(names)
+        self.parents = list(parents)
+        self.heads = np.array(heads, dtype=float).reshape(-1, 3)
+        self.tails = np.array(tails, dtype=float).reshape(-1, 3)
+        if connected is None:
+            connected = [False] * len(self.names)
+        self.connected = list(connected)
+        self.index = dict((name, c) for c, name in enumerate(self.names))
+        # Children of every bone, built on first use and dropped when the
+        # hierarchy changes
+        self.childIndex = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def parent(self, name):
+        parent = self.parents[self.index[name]]
+        return self.names[parent] if parent >= 0 else None
+
+    def childLists(self):
+        if self.childIndex is None:
+            self.childIndex = [[] for _ in self.names]
+            for c, parent in enumerate(self.parents):
+                if parent >= 0:
+                    self.childIndex[parent].append(c)
+        return self.childIndex
+
+    def children(self, name):
+        return [self.names[i] for i in self.childLists()[self.index[name]]]
+
+    # Every bone below name, parents before their children
+    def childrenRecursive(self, name):
+        children = self.childLists()
+        bones = []
+        stack = list(reversed(children[self.index[name]]))
+        while stack:
+            c = stack.pop()
+            bones.append(self.names[c])
+            stack.extend(reversed(children[c]))
+        return bones
+
+    # tail - head of a bone
+    def vector(self, name):
+        c = self.index[name]
+        return self.tails[c] - self.heads[c]
+
+    def reparent(self, name, parent):
+        self.parents[self.index[name]] = self.index[parent]
+        self.childIndex = None
+
+    # Deletes bones, their children go to the deleted bone's parent (like
+    # removing an edit bone in Blender)
+    def remove(self, names):
+        gone = set(self.index[name] for name in names)
+        keep = [c for c in range(len(self.names)) if c not in gone]
+        new = dict((c, i) for i, c in enumerate(keep))
+
+        parents = []
+        for c in keep:
+            parent = self.parents[c]
+            while parent in gone:
+                parent = self.parents[parent]
+            parents.append(new[parent] if parent >= 0 else -1)
+
+        self.__init__([self.names[c] for c in keep], parents,
+                      self.heads[keep], self.tails[keep],
+                      [self.connected[c] for c in keep])
+
+    # Connects a bone to its parent's tail and sets its tail to head + vec
+    def connect(self, name, vec):
+        c = self.index[name]
+        self.connected[c] = True
+        self.heads[c] = self.tails[self.parents[c]]
+        self.tails[c] = self.heads[c] + vec
+
+    # Adds the bones of another skeleton (like joining armatures in
+    # Blender, names that are taken get a ".001" suffix)
+    # Returns {name in other: name in self}
+    def join(self, other):
+        renames = {}
+        taken = set(self.names)
+        for name in other.names:
+            new, n = name, 0
+            while new in taken:
+                n += 1
+                new = "%s.%03d" % (name, n)
+            renames[name] = new
+            taken.add(new)
+
+        offset = len(self.names)
+        parents = [p + offset if p >= 0 else -1 for p in other.parents]
+        self.__init__(self.names + [renames[n] for n in other.names],
+                      self.parents + parents,
+                      np.concatenate((self.heads, other.heads)),
+                      np.concatenate((self.tails, other.tails)),
+                      self.connected + other.connected)
+        return renames
+
+
+# ==========================================================================
+#   Animation of a take, the BVH channels of every bone
+#   channels = {bone: channel names}, values = {bone: (frames, n) array}
+# ==========================================================================
+class Action(object):
+
+    def __init__(self, frames, frame_time, channels=None, values=None):
+        self.frames = frames
+        self.frame_time = frame_time
+        self.channels = channels or {}
+        self.values = values or {}
+
+    # Values of every frame, cut or held on the last frame (like an FCurve
+    # past its last key) when the other take has a different length
+    def fit(self, values):
+        values = np.asarray(values, dtype=np.float32)
+        if len(values) >= self.frames:
+            return values[:self.frames]
+        if len(values) == 0:
+            return np.zeros((self.frames,) + values.shape[1:], np.float32)
+        pad = np.repeat(values[-1:], self.frames - len(values), axis=0)
+        return np.concatenate((values, pad))
+
+    # X, Y, Z rotation of a bone (degrees), (frames, 3)
+    def rotation(self, name):
+        rot = np.zeros((self.frames, 3), dtype=np.float32)
+        channels = self.channels.get(name, [])
+        for axis, channel in enumerate(ROTATIONS):
+            if channel in channels:
+                rot[:, axis] = self.values[name][:, channels.index(channel)]
+        return rot
+
+    # Copies the channels of a bone of another action, renamed to target
+    def copy(self, other, name, target=None):
+        target = target or name
+        self.channels[target] = list(other.channels[name])
+        self.values[target] = self.fit(other.values[name])
+
+
+# ==========================================================================
+#   Skeleton and action of a parsed BVH (see bvh_reader.read)
+#   Heads are the summed offsets, tails go to the End Site or to the mean
+#   head of the children (like Blender's BVH importer)
+# ==========================================================================
+def fromBVH(bvh):
+    count = len(bvh.names)
+    heads = np.zeros((count, 3))
+    for c in range(count):
+        parent = bvh.parents[c]
+        heads[c] = bvh.offsets[c] + (heads[parent] if parent >= 0 else 0)
+
+    tails = heads.copy()
+    sums = np.zeros((count, 3))
+    counts = np.zeros(count)
+    for c in range(count):
+        parent = bvh.parents[c]
+        if parent >= 0:
+            sums[parent] += heads[c]
+            counts[parent] += 1
+    for c in range(count):
+        if c in bvh.end_sites:
+            tails[c] = heads[c] + bvh.end_sites[c]
+        elif counts[c]:
+            tails[c] = sums[c] / counts[c]
+        elif bvh.parents[c] >= 0:
+            # Leaf without End Site: same direction as its parent
+            parent = bvh.parents[c]
+            tails[c] = heads[c] + (heads[c] - heads[parent])
+
+    skeleton = Skeleton(bvh.names, bvh.parents.tolist(), heads, tails)
+    action = Action(len(bvh), bvh.frame_time)
+    for name, channels in zip(bvh.names, bvh.channels):
+        action.channels[name] = list(channels)
+        action.values[name] = np.array(bvh.joint(name))
+    return skeleton, action
+
+
+# ==========================================================================
+#   BVH of a CSV recording, the same one csv2bvh.py writes
+#   hand = "left" or "right" (default: from the file name)
+# ==========================================================================
+def readCSV(filename, hand=None):
+    from csv2bvh import hierarchy, motion
+    from leap_data import INDEX, handedness, load
+
+    is_left = (hand or handedness(filename)) == "left"
+    table = np.asarray(load(filename).table)
+    if len(table) == 0:
+        raise ValueError("%s has no frames" % filename)
+
+    header = createHeader(*hierarchy(table[0], is_left))
+    names, parents, offsets, channels, end_sites = \
+        parseHierarchy(header.splitlines())
+    values = np.array(" ".join(motion(table, is_left)).split(),
+                      dtype=np.float32)
+
+    # Timestamps are in microseconds
+    stamps = table[:, INDEX['Timestamp']]
+    frame_time = ((stamps[-1] - stamps[0]) / 1e6 / (len(table) - 1)
+                  if len(table) > 1 else 0)
+    return BVH(names, parents, offsets, channels, end_sites, frame_time,
+               values.reshape(len(table), -1))
+
+
+# ==========================================================================
+#   Skeleton and action of a BVH file or of a CSV recording
+# ==========================================================================
+def load(filename, hand=None):
+    if filename.lower().endswith(".csv"):
+        return fromBVH(readCSV(filename, hand))
+    return fromBVH(read(filename))
+
+
+# ==========================================================================
+#   Attaches the hands to the body's hand bones, in place
+#   Parents every hand root to the body hand, deletes the body's fingers
+#   (bones below the body hand starting with its "l"/"r" prefix) and
+#   connects the hand bones to their parent keeping their length
+#   Returns the hand bones, below every hand root
+# ==========================================================================
+def attachSkeleton(skeleton, body_hands=BODY_HANDS, hands=HANDS):
+    # Length of every bone of the hands, before connecting moves them
+    vecs = {}
+    remove = []
+    for body_hand, hand in zip(body_hands, hands):
+        skeleton.reparent(hand, body_hand)
+        for child in skeleton.childrenRecursive(body_hand):
+            if child[:1] == body_hand[:1]:
+                remove.append(child)
+            else:
+                vecs[child] = skeleton.vector(child)
+    skeleton.remove(remove)
+
+    bones = []
+    for hand in hands:
+        skeleton.connect(hand, vecs[hand])
+        for bone in skeleton.childrenRecursive(hand):
+            skeleton.connect(bone, vecs[bone])
+            bones.append(bone)
+    return bones
+
+
+# ==========================================================================
+#   Merges a body take with a left and a right hand take
+#   body, left and right are (Skeleton, Action) pairs, see load
+#   Returns the (Skeleton, Action) of the body with the hands attached
+# ==========================================================================
+def attach(body, left, right, body_hands=BODY_HANDS, hands=HANDS):
+    skeleton = Skeleton(body[0].names, body[0].parents, body[0].heads,
+                        body[0].tails, body[0].connected)
+    action = Action(body[1].frames, body[1].frame_time,
+                    dict(body[1].channels), dict(body[1].values))
+
+    # Hands joined in order, the second hand's fingers get ".001" names
+    renames = [skeleton.join(left[0]), skeleton.join(right[0])]
+    bones = attachSkeleton(skeleton, body_hands, hands)
+
+    # Rotations of the fingers, the hand roots keep the body's
+    for (_, hand_action), names in zip((left, right), renames):
+        for name, new in names.items():
+            if new in bones:
+                action.copy(hand_action, name, new)
+    for name in list(action.values):
+        if name not in skeleton:
+            del action.channels[name], action.values[name]
+    return skeleton, action
+
+
+# ==========================================================================
+#   Writes a skeleton and its action as a BVH file
+#   Bones are written parents first; bones without channels in the action
+#   get rotation channels with no motion. Leaf bones get an End Site
+# ==========================================================================
+def writeBVH(filename, skeleton, action):
+    children = [[] for _ in skeleton.names]
+    roots = []
+    for c, parent in enumerate(skeleton.parents):
+        (children[parent] if parent >= 0 else roots).append(c)
+
+    # Same order as createHierarchy, so the motion columns match the header
+    order = []
+    stack = list(reversed(roots))
+    while stack:
+        c = stack.pop()
+        order.append(c)
+        stack.extend(reversed(children[c]))
+    new = dict((c, i) for i, c in enumerate(order))
+
+    names = [skeleton.names[c] for c in order]
+    parents = [new[skeleton.parents[c]] if skeleton.parents[c] >= 0 else -1
+               for c in order]
+    offsets, channels, end_sites, columns = [], [], {}, []
+    for i, c in enumerate(order):
+        parent = skeleton.parents[c]
+        offset = skeleton.heads[c] - (skeleton.heads[parent]
+                                      if parent >= 0 else 0)
+        offsets.append(" ".join("%g" % v for v in offset))
+        if not children[c]:
+            end_sites[i] = " ".join("%g" % v for v in skeleton.vector(
+                skeleton.names[c]))
+
+        name = skeleton.names[c]
+        if name in action.channels:
+            channels.append("%d %s" % (len(action.channels[name]),
+                                       " ".join(action.channels[name])))
+            columns.append(action.fit(action.values[name]))
+        else:
+            channels.append(JOINT_CHANNELS)
+            columns.append(np.zeros((action.frames, 3), np.float32))
+
+    with open(filename, "w") as f:
+        f.write(createHierarchy(names, parents, offsets, end_sites,
+                                channels))
+        f.write("MOTION\nFrames: %d\nFrame Time: %r\n"
+                % (action.frames, float(action.frame_time)))
+        np.savetxt(f, np.concatenate(columns, axis=1), fmt="%g")
+
+
+def merge(body, left, right, output):
+    skeleton, action = attach(load(body), load(left, "left"),
+                              load(right, "right"))
+    writeBVH(output, skeleton, action)
+    return output
+
+
+def _job(args):
+    return merge(*args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Attach hand takes to body takes")
+    parser.add_argument("takes", nargs="+",
+                        help="body, left hand and right hand of every take")
+    parser.add_argument("-o", "--outdir",
+                        help="folder of the merged BVH files (default: "
+                             "next to the body BVH)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of processes (default: every core)")
+    args = parser.parse_args(argv)
+    if len(args.takes) % 3:
+        parser.error("takes come in body, left, right triples")
+
+    if args.outdir and not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+
+    jobs = []
+    for i in range(0, len(args.takes), 3):
+        body, left, right = args.takes[i:i + 3]
+        output = os.path.splitext(body)[0] + "_hands.bvh"
+        if args.outdir:
+            output = os.path.join(args.outdir, os.path.basename(output))
+        jobs.append((body, left, right, output))
+
+    # A failed take is reported and the others carry on
+    failed = 0
+    with ProcessPoolExecutor(args.jobs) as pool:
+        futures = dict((pool.submit(_job, job), job[0]) for job in jobs)
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                output = future.result()
+            except Exception as e:
+                failed += 1
+                print("[%d/%d] %s failed: %s"
+                      % (done, len(jobs), futures[future], e),
+                      file=sys.stderr)
+                continue
+            print("[%d/%d] %s" % (done, len(jobs), output))
+
+    print("Merged %d takes (%d failed)" % (len(jobs) - failed, failed))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,65 +1,221 @@
+import bisect
+
 from pyfbsdk import *
 
+# Keys of the scale animation: 'ends' (start and stop of the take only),
+# 'second' (one key per second) or 'frame' (one key per frame)
+KEYS = 'ends'
+# Text file of "time scale" lines (seconds from the start of the take), used
+# instead of the 1x to 5x ramp and resampled to the keys (e.g. written from
+# a Leap recording, see proportions.py --curve)
+SCALE_FILE = None
+
 def DeselectAll():
     for model in FBSystem().Scene.Components:
         model.Selected = False
 
+def CollectBranch(topModel):
+    '''
+    Returns the given model and all of its descendants, parents before their
+    children. The hierarchy is walked with a stack instead of recursion, so
+    deep chains don't hit Python's recursion limit, and the selection of the
+    scene is left alone
+    '''
+    models = []
+    stack = [topModel]
+    while stack:
+        model = stack.pop()
+        models.append(model)
+        children = list(model.Children)
+        children.reverse()
+        stack.extend(children)
+    return models
+
+def CollectBranches(topModels):
+    '''
+    CollectBranch of several models, every model is listed once even when
+    the branches overlap
+    '''
+    models = []
+    seen = set()
+    for topModel in topModels:
+        for model in CollectBranch(topModel):
+            if model.LongName not in seen:
+                seen.add(model.LongName)
+                models.append(model)
+    return models
+
 def SelectBranch(topModel):
     '''
     Selects the given model and all of its descendants. Note that this
     function does not clear the current selection -- that's the caller's
     responsibility, if desired.
     '''
-    for childModel in topModel.Children:
-        SelectBranch(childModel)
+    for model in CollectBranch(topModel):
+        model.Selected = True
 
-    topModel.Selected = True
+def ScalingNodes(models):
+    '''
+    the scaling animation nodes of the models (models that don't have one
+    are skipped)
+    '''
+    nodes = []
+    for model in models:
+        animationNode = model.Scaling.GetAnimationNode()
+        if animationNode is not None and len(animationNode.Nodes) != 0:
+            nodes.append(animationNode)
+    return nodes
 
-def SetScaling(animationNode):
+def SetScaling(animationNodes):
     '''
     iterates through all the animation nodes Nodes(which indicates by x node[0],
     y node[1], and z node[2] and add key frames to them which scales the model
     up from default size to 5x the size towards the end of the animation
+    the take's time span is read once for all the nodes, and the keys of
+    every FCurve are added between EditBegin and EditEnd so the curve is
+    only updated once
     '''
-    if len(animationNode.Nodes) != 0:
-        startTime = FBSystem().CurrentTake.LocalTimeSpan.GetStart()
-        stopTime = FBSystem().CurrentTake.LocalTimeSpan.GetStop()    
+    startTime = FBSystem().CurrentTake.LocalTimeSpan.GetStart()
+    stopTime = FBSystem().CurrentTake.LocalTimeSpan.GetStop()
+    for animationNode in animationNodes:
         for dirNode in animationNode.Nodes:
             '''
-            We can actually get fancier in here and add key frames to each second
-            this requires intervals to be keyed instead of just a beginning and an end
+            keys every frame or second are added by SetScalingCurve
             '''
-            dirNode.FCurve.KeyAdd(startTime, 1.0)
-            dirNode.FCurve.KeyAdd(stopTime, 5.0)
-        
+            fcurve = dirNode.FCurve
+            fcurve.EditBegin(2)
+            fcurve.KeyAdd(startTime, 1.0)
+            fcurve.KeyAdd(stopTime, 5.0)
+            fcurve.EditEnd(2)
+
 def ScaleChild( model ):
     '''
-    models normally have scaling, rotation and translation animation nodes 
-    which we can manipulate
+    models normally have scaling, rotation and translation animation nodes
+    which we can manipulate, this keys the model and all of its descendants
+    '''
+    SetScaling(ScalingNodes(CollectBranch(model)))
+
+
+
+def KeyFrames(step):
+    '''
+    frames of the current take from its start to its stop, every "step"
+    frames (the stop frame is always keyed)
+    '''
+    span = FBSystem().CurrentTake.LocalTimeSpan
+    startFrame = span.GetStart().GetFrame()
+    stopFrame = span.GetStop().GetFrame()
+    frames = list(range(startFrame, stopFrame, max(1, int(step))))
+    frames.append(stopFrame)
+    return frames
+
+def RampValues(count, startScale=1.0, stopScale=5.0):
+    '''
+    "count" scale values going linearly from startScale to stopScale
+    '''
+    if count < 2:
+        return [stopScale] * count
+    delta = (stopScale - startScale) / float(count - 1)
+    return [startScale + i * delta for i in range(count)]
+
+def ReadScaleValues(filename):
+    '''
+    (time, scale) samples of a text file, one "time scale" line per sample,
+    sorted by time
+    '''
+    samples = []
+    with open(filename) as f:
+        for number, line in enumerate(f, 1):
+            words = line.split()
+            if not words:
+                continue
+            if len(words) != 2:
+                raise ValueError("%s:%d: expected 'time scale', got %r"
+                                 % (filename, number, line.strip()))
+            samples.append((float(words[0]), float(words[1])))
+    if not samples:
+        raise ValueError("%s has no scale values" % filename)
+    samples.sort()
+    return samples
+
+def ResampleScale(samples, times):
+    '''
+    the scale at every time of "times" (seconds), linearly interpolated
+    between the (time, scale) samples. Times before the first sample or
+    after the last one get its scale
+    '''
+    sampleTimes = [time for time, value in samples]
+    values = []
+    for time in times:
+        i = bisect.bisect_right(sampleTimes, time)
+        if i == 0:
+            values.append(samples[0][1])
+        elif i == len(samples):
+            values.append(samples[-1][1])
+        else:
+            t0, v0 = samples[i - 1]
+            t1, v1 = samples[i]
+            values.append(v0 + (v1 - v0) * (time - t0) / (t1 - t0))
+    return values
+
+def BuildCurve(frames, values):
+    '''
+    a standalone FCurve with a key of "values" at every frame of "frames",
+    keyed in a single edit
     '''
-    SetScaling(model.Scaling.GetAnimationNode())
-    for child in model.Children:
-        ScaleChild(child)
+    if len(frames) != len(values):
+        raise ValueError("%d scale values for %d keys"
+                         % (len(values), len(frames)))
+    curve = FBFCurve()
+    curve.EditBegin(len(frames))
+    for frame, value in zip(frames, values):
+        curve.KeyAdd(FBTime(0, 0, 0, frame), value)
+    curve.EditEnd(len(frames))
+    return curve
+
+def SetScalingCurve(animationNodes, curve):
+    '''
+    gives the keys of "curve" to the x, y and z nodes of every animation
+    node. The curve is built once and each node's FCurve is replaced by it
+    in one call, instead of one KeyAdd per key per node
+    '''
+    for animationNode in animationNodes:
+        for dirNode in animationNode.Nodes:
+            dirNode.FCurve.KeyReplaceBy(curve)
+
+def ScaleCurve(keys=KEYS, scaleFile=SCALE_FILE):
+    '''
+    the scale curve of the current take for the 'second' or 'frame' keys,
+    a ramp from 1x to 5x or the values of scaleFile at the time of every key
+    '''
+    fps = FBPlayerControl().GetTransportFpsValue()
+    if keys == 'second':
+        step = fps
+    else:
+        step = 1
+    frames = KeyFrames(step)
+    if scaleFile:
+        times = [(frame - frames[0]) / float(fps) for frame in frames]
+        values = ResampleScale(ReadScaleValues(scaleFile), times)
+    else:
+        values = RampValues(len(frames))
+    return BuildCurve(frames, values)
 
 
 
 def main():
     '''
-    in order to work with the models we must select them first? 
+    the hand subtrees are collected directly from the models, without
+    going through the scene selection
     '''
-    DeselectAll()
-    
     rightHand = FBFindModelByLabelName('BVH:rHand')
-    SelectBranch(rightHand)
-    
     leftHand = FBFindModelByLabelName('BVH:lHand')
-    SelectBranch(leftHand)
-    
-    selectedModels = FBModelList()
-    FBGetSelectedModels(selectedModels)
-    
-    for model in selectedModels:
-        ScaleChild(model)
+
+    nodes = ScalingNodes(CollectBranches([rightHand, leftHand]))
+    if KEYS == 'ends':
+        SetScaling(nodes)
+    else:
+        SetScalingCurve(nodes, ScaleCurve(KEYS, SCALE_FILE))
 
 if __name__ in ('__main__', '__builtin__'):
     main()
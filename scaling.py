@@ -1,132 +1,177 @@
+import os
+import sys
 import bpy
-import math
-import re
 import mathutils
+from numpy import empty, float32
+
+# Blender does not put the script's folder on the path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bone_index import BoneIndex
+from calibration import loadCalibration
+import proportions
 
 
 class Scaler:
 
     # according to hypertextbook.com/facts/2006/bodyproportions.shtml
     # forarm+hand vs forarm ratio
-    GOLDEN_RATIO = 1.618
+    GOLDEN_RATIO = proportions.GOLDEN_RATIO
 
     # name of the forarm bone, should always be this name
-    FOREARM = 'forearm'
+    FOREARM = proportions.FOREARM
 
     # name of the hand objects after imported into blender
     leftHandName = ''
     rightHandName = ''
     modelName = ''
 
-    def __init__(self, modelName, leftHandName, rightHandName):
+    # calibration = calibration file of the subject (see calibration.py),
+    # its hand lengths are used instead of measuring the hand armatures
+    def __init__(self, modelName, leftHandName, rightHandName,
+                 calibration=None):
         self.leftHandName = leftHandName
         self.rightHandName = rightHandName
         self.modelName = modelName
-
-    # get the total length of all the children bone
-    def childrenBoneLength(self, children):
-        length = 0
-
-        for bone in children:
-            length += bone.length
-
-        return length
+        self.calibration = None
+        if calibration:
+            self.calibration = loadCalibration(calibration)['hands']
+        # measurements of every armature, see measure
+        self.cache = {}
+
+    # fingerprint of an armature's bones: their rest head, tail and length
+    # read in bulk, any edit of the bones changes it
+    def getSignature(self, bones):
+        data = []
+        for name, size in (('head_local', 3), ('tail_local', 3),
+                           ('length', 1)):
+            values = empty(size * len(bones), dtype=float32)
+            bones.foreach_get(name, values)
+            data.append(values.tobytes())
+        return hash((len(bones),) + tuple(data))
+
+    # cache entry of an armature, holding its BoneIndex (plain data only,
+    # no Blender bones) and its measurements
+    # it is rebuilt the first time or after the armature's bones changed
+    def getEntry(self, armatureName):
+        bones = bpy.data.armatures[armatureName].bones
+        signature = self.getSignature(bones)
+        entry = self.cache.get(armatureName)
+        if entry is None or entry['signature'] != signature:
+            entry = {'signature': signature,
+                     'bones': BoneIndex(bones, keepBones=False)}
+            self.cache[armatureName] = entry
+        return entry
+
+    # cached measurement of an armature, compute(bones) is only called
+    # when the entry doesn't have it yet
+    def measure(self, armatureName, key, compute):
+        entry = self.getEntry(armatureName)
+        if key not in entry:
+            entry[key] = compute(entry['bones'])
+        return entry[key]
+
+    # forget the measurements of an armature (or all of them), scaleHands
+    # calls it after every edit it makes
+    def invalidate(self, armatureName=None):
+        if armatureName is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(armatureName, None)
+
+    # bone index of an armature, see bone_index.py
+    def getBones(self, armatureName):
+        return self.getEntry(armatureName)['bones']
+
+    # length of a bone and every bone below it
+    def chainLength(self, bones, name):
+        return bones.length(name) + sum(
+            bones.length(child) for child in bones.childrenRecursive(name))
 
     # calculate the length of the leap hand imported into blender
     def getLeapHandLength(self, hand):
         middleFinger = 'Middle_Metacarpal'
-        # assuming the model is always loaded after the body model
-        armatures = bpy.data.armatures[hand]
-        if armatures is not None:
-            bones = armatures.bones
+
+        # calibrated over whole takes of the subject, which are keyed by
+        # side ('left' or 'right') rather than by the armature's name
+        side = {self.leftHandName: 'left',
+                self.rightHandName: 'right'}.get(hand)
+        if self.calibration and side in self.calibration:
+            return self.calibration[side]['hand_length']
+
+        def compute(bones):
             if middleFinger in bones:
-                finger = bones[middleFinger]
-                return finger.length + \
-                    self.childrenBoneLength(finger.children_recursive)
+                return self.chainLength(bones, middleFinger)
+            return -1
 
-        return -1
+        # assuming the model is always loaded after the body model
+        return self.measure(hand, 'leapHand', compute)
 
     # calculates the length of the hand on the model
     def getModelHandLength(self):
         middleFinger = 'lMid1'
         hand = 'lHand'
-        armatures = bpy.data.armatures[self.modelName]
-        if armatures is not None:
-            bones = armatures.bones
+
+        def compute(bones):
             if middleFinger in bones:
-                finger = bones[middleFinger]
-                return bones[hand].length + finger.length + \
-                    self.childrenBoneLength(finger.children_recursive)
+                return bones.length(hand) + \
+                    self.chainLength(bones, middleFinger)
+            return -1
 
-        return -1
+        return self.measure(self.modelName, 'modelHand', compute)
 
     # returns the length of the forearm of the model
     def getForeArmLength(self):
-        # assuming the model is always loaded first
-        armatures = bpy.data.armatures[self.modelName]
-        if armatures is not None:
-            bones = armatures.bones
-            for bone in bones:
-                if re.search(self.FOREARM, bone.name, re.IGNORECASE):
-                    return bone.length
+        def compute(bones):
+            return proportions.foreArmLength(bones.lengths, bones.names,
+                                             self.FOREARM)
 
-        return -1
+        # assuming the model is always loaded first
+        return self.measure(self.modelName, 'foreArm', compute)
 
     # returns the scale factor required to scale the leap hand model
+    # same computation as proportions.scaleFactor, which works without
+    # Blender on BVH files and CSV recordings
     def getScaleFactor(self, hand):
-        scaleFactor = 0
-
         foreArmLength = self.getForeArmLength()
         modelHandLength = self.getModelHandLength()
         leapHandLength = self.getLeapHandLength(hand)
 
-        if foreArmLength > 0:
-            if modelHandLength < 0:
-                # in case where there isnt a hand available
-                # we scale it based on the golden ratio
-                modelHandLength = (
-                    self.GOLDEN_RATIO *
-                    foreArmLength -
-                    foreArmLength)
-
-            scaleFactor = leapHandLength/modelHandLength
-
-        return math.fabs(scaleFactor)
+        return float(proportions.scaleFactor(leapHandLength, foreArmLength,
+                                             modelHandLength,
+                                             self.GOLDEN_RATIO))
 
     # scales the hand
+    def scaleHand(self, hand):
+        self.scaleHands([hand])
+
+    # scales several hands against the model in one pass
+    # the model is measured once and every hand armature is scaled with
+    # Armature.transform, which works on the bones without going through
+    # edit mode (same as bone.transform(mat, scale=True) on every edit bone)
     # possible other ways:
     # 1. bpy.ops.transform.resize
     # 2. iterate through every bone of the hand and resize
-    def scaleHand(self, hand):
-        bpySceneObj = bpy.context.scene.objects
+    def scaleHands(self, hands):
         bpyDataObj = bpy.data.objects
-        bpyOpsObj = bpy.ops.object
-
-        # set the active object to be resized
-        bpySceneObj.active = bpyDataObj.get(hand)
-        handModel = bpyDataObj[hand]
-        bpyObj = bpy.context.object
-        if handModel is not None:
-            scaleFactor = self.getScaleFactor(hand)
-            if scaleFactor != 0:
-                scaleFactor = 1/scaleFactor
-                # scale each individual bone in the hand
-                bpyOpsObj.mode_set(mode='EDIT')
 
-                mat = mathutils.Matrix.Scale(scaleFactor, 3)
+        # bones are only transformed in object mode
+        if bpy.context.object is not None and \
+                bpy.context.object.mode != 'OBJECT':
+            bpy.ops.object.mode_set(mode='OBJECT')
 
-                for bone in bpyObj.data.edit_bones:
-                    bone.transform(mat,  scale=True, roll=False)
+        scaleFactors = [self.getScaleFactor(hand) for hand in hands]
 
-                bpyOpsObj.mode_set(mode='OBJECT')
-
-        bpySceneObj.active = None
+        for hand, scaleFactor in zip(hands, scaleFactors):
+            handModel = bpyDataObj.get(hand)
+            if handModel is not None and scaleFactor != 0:
+                mat = mathutils.Matrix.Scale(1/scaleFactor, 4)
+                handModel.data.transform(mat)
+                self.invalidate(hand)
 
     # scales both hands imported into leap
     def scaleBothHands(self):
-        self.scaleHand(self.leftHandName)
-        self.scaleHand(self.rightHandName)
-
+        self.scaleHands([self.leftHandName, self.rightHandName])
 
 x = Scaler('73_13', 'left', 'right')
 x.scaleBothHands()